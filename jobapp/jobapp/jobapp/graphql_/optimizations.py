@@ -0,0 +1,107 @@
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from graphene.utils.str_converters import to_snake_case
+from graphene_django.registry import get_global_registry
+from graphql.language.ast import Field, FragmentSpread, InlineFragment
+
+
+def _selections(selection_set, fragments):
+    # Flatten fragments so that only plain field selections are yielded.
+    for selection in selection_set.selections:
+        if isinstance(selection, Field):
+            yield selection
+        elif isinstance(selection, FragmentSpread):
+            fragment = fragments[selection.name.value]
+            yield from _selections(fragment.selection_set, fragments)
+        elif isinstance(selection, InlineFragment):
+            yield from _selections(selection.selection_set, fragments)
+
+
+def _unwrap_connection(selection_set, fragments):
+    # For relay connections the model fields are under edges { node { ... } }
+    for selection in _selections(selection_set, fragments):
+        if selection.name.value == 'edges' and selection.selection_set:
+            for edge_selection in _selections(selection.selection_set, fragments):
+                if edge_selection.name.value == 'node':
+                    return edge_selection.selection_set
+    return selection_set
+
+
+def _base_queryset(model):
+    # As the model's node type lists it, e.g. without unexposed columns.
+    queryset = model._default_manager.all()
+    node_type = get_global_registry().get_type_for_model(model)
+    base_queryset = getattr(node_type, 'base_queryset', None)
+    if base_queryset is not None:
+        queryset = base_queryset(queryset)
+    return queryset
+
+
+def _collect(model, selection_set, fragments, prefix=''):
+    select_related, prefetch_related = [], []
+    for selection in _selections(selection_set, fragments):
+        if selection.selection_set is None:
+            # Scalar field, nothing to join.
+            continue
+        name = to_snake_case(selection.name.value)
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            continue
+        if not field.is_relation or field.related_model is None:
+            continue
+        path = f'{prefix}{name}'
+        if field.many_to_one or field.one_to_one:
+            # Single valued relation, join it and keep walking from there.
+            select_related.append(path)
+            nested_select, nested_prefetch = _collect(
+                field.related_model,
+                selection.selection_set,
+                fragments,
+                prefix=f'{path}__'
+            )
+            select_related.extend(nested_select)
+            prefetch_related.extend(nested_prefetch)
+        else:
+            # Multi valued relation, prefetch with its own optimized queryset.
+            queryset = _optimize(
+                _base_queryset(field.related_model),
+                _unwrap_connection(selection.selection_set, fragments),
+                fragments
+            )
+            prefetch_related.append(Prefetch(path, queryset=queryset))
+    return select_related, prefetch_related
+
+
+def _optimize(queryset, selection_set, fragments, select_related=(), prefetch_related=()):
+    selects, prefetches = _collect(queryset.model, selection_set, fragments)
+    selects.extend(select_related)
+    prefetches.extend(prefetch_related)
+    if selects:
+        queryset = queryset.select_related(*selects)
+    if prefetches:
+        queryset = queryset.prefetch_related(*prefetches)
+    return queryset
+
+
+def optimize_queryset(queryset, info, select_related=(), prefetch_related=()):
+    """
+    Add select_related/prefetch_related to queryset for the relations
+    requested in the query, so that graphene does not hit the db per row.
+
+    Extra select_related/prefetch_related paths can be passed for relations
+    which can not be derived from the query (e.g. used by custom resolvers).
+    """
+    # Already evaluated (e.g. prefetched by the parent), leave it as is.
+    if queryset._result_cache is not None:
+        return queryset
+    selection_set = info.field_asts[0].selection_set
+    if selection_set is None:
+        return queryset
+    return _optimize(
+        queryset,
+        _unwrap_connection(selection_set, info.fragments),
+        info.fragments,
+        select_related=select_related,
+        prefetch_related=prefetch_related
+    )
@@ -0,0 +1,114 @@
+import graphene
+from graphene import relay
+from graphene_django import DjangoObjectType, DjangoConnectionField
+from graphene_django.converter import convert_django_field
+from graphene_django.utils import maybe_queryset
+from django.contrib.auth.models import Group
+from django.db.models import JSONField
+
+from jobapp.rest_api import models
+from .optimizations import optimize_queryset
+
+
+@convert_django_field.register(JSONField)
+def convert_json_field(field, registry=None):
+    # graphene-django 2 only knows contrib.postgres' JSONField, as
+    # JSONString like that one (also covers OrjsonJSONField).
+    return graphene.JSONString(description=field.help_text, required=not field.null)
+
+
+class OptimizedObjectType(DjangoObjectType):
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def base_queryset(cls, queryset):
+        # Applied to lists of this type, top level and nested (prefetched).
+        return queryset
+
+    @classmethod
+    def get_queryset(cls, queryset, info):
+        # Nested connections pass the related manager
+        queryset = maybe_queryset(queryset)
+        if queryset._result_cache is None:
+            queryset = cls.base_queryset(queryset)
+        return optimize_queryset(queryset, info)
+
+
+class UserType(OptimizedObjectType):
+    class Meta:
+        interfaces = (relay.Node,)
+        model = models.User
+        fields = ('id', 'username', 'first_name', 'last_name', 'email', 'groups', 'groupsets')
+
+
+class GroupType(OptimizedObjectType):
+    class Meta:
+        interfaces = (relay.Node,)
+        model = Group
+        fields = ('id', 'name', 'groupsets')
+
+
+class GroupsetType(OptimizedObjectType):
+    class Meta:
+        interfaces = (relay.Node,)
+        model = models.Groupset
+        fields = ('id', 'name', 'users', 'groups', 'groupset_jobs')
+
+
+class JobDiagnosticType(OptimizedObjectType):
+    class Meta:
+        interfaces = (relay.Node,)
+        model = models.JobDiagnostic
+        fields = ('id', 'severity', 'created_at', 'message', 'details', 'stage', 'step')
+
+
+class GroupsetJobType(OptimizedObjectType):
+    status = graphene.Int()
+    ui_status = graphene.String()
+    percent_progress = graphene.Float()
+
+    class Meta:
+        interfaces = (relay.Node,)
+        model = models.GroupsetJob
+        fields = (
+            'id',
+            'type',
+            'created_by',
+            'description',
+            'created_at',
+            'updated_at',
+            'groupset',
+            'diagnostics',
+        )
+
+    @classmethod
+    def base_queryset(cls, queryset):
+        # _data is not exposed. Only GroupsetJob fields are, so rows are
+        # not downcast to their job classes (a query per job class).
+        return queryset.without_data().non_polymorphic()
+
+
+class Query(graphene.ObjectType):
+    # Top level lists must be paginated with first/last, page size is capped
+    # by RELAY_CONNECTION_MAX_LIMIT.
+    users = DjangoConnectionField(UserType, enforce_first_or_last=True)
+    groups = DjangoConnectionField(GroupType, enforce_first_or_last=True)
+    groupsets = DjangoConnectionField(GroupsetType, enforce_first_or_last=True)
+    jobs = DjangoConnectionField(GroupsetJobType, enforce_first_or_last=True)
+
+    # Plain ordered querysets, optimized once by the node types' get_queryset
+    def resolve_users(self, info, **kwargs):
+        return models.User.objects.order_by('pk')
+
+    def resolve_groups(self, info, **kwargs):
+        return Group.objects.order_by('pk')
+
+    def resolve_groupsets(self, info, **kwargs):
+        return models.Groupset.objects.order_by('pk')
+
+    def resolve_jobs(self, info, **kwargs):
+        return models.GroupsetJob.objects.order_by('pk')
+
+
+schema = graphene.Schema(query=Query)
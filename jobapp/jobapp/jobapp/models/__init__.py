@@ -13,5 +13,6 @@ from .jobs import (
     GOOD_STATUSES,
     BAD_STATUSES
 )
-from .diagnostics import AbstractDiagnostic, AbstractStepDiagnostic, Severity
-from .notifiers import AbstractJobNotifier, DbUpdateNotifier
+from .diagnostics import AbstractDiagnostic, AbstractStepDiagnostic, DiagnosticQuerySet, Severity
+from .notifiers import AbstractJobNotifier, DbUpdateNotifier, BatchedDbUpdateNotifier
+from .fields import OrjsonJSONField
@@ -1,4 +1,8 @@
-from django.db import models
+import io
+
+from django.db import connections, models
+from django.utils import timezone
+from .fields import OrjsonJSONField
 
 
 class Severity(models.IntegerChoices):
@@ -7,13 +11,60 @@ class Severity(models.IntegerChoices):
     CRITICAL = 3
 
 
+# Unquoted in COPY csv rows for None, quoted values (e.g. '') are never NULL.
+_COPY_NULL = r'\N'
+
+
+def _copy_csv_value(value):
+    if value is None:
+        return _COPY_NULL
+    # Quoted, COPY casts quoted csv values to the column type as well.
+    return '"%s"' % str(value).replace('"', '""')
+
+
+class DiagnosticQuerySet(models.QuerySet):
+    # COPY pays off over parameterized INSERTs for many rows only
+    COPY_THRESHOLD = 1000
+
+    def bulk_copy(self, objs, batch_size=None):
+        """
+        Like bulk_create but through postgres COPY for many rows, primary
+        keys of copied diagnostics are not set.
+        """
+        connection = connections[self.db]
+        if len(objs) < self.COPY_THRESHOLD or connection.vendor != 'postgresql':
+            return self.bulk_create(objs, batch_size=batch_size)
+        opts = self.model._meta
+        fields = [f for f in opts.concrete_fields if f is not opts.auto_field]
+        buffer = io.StringIO()
+        for obj in objs:
+            buffer.write(','.join(
+                _copy_csv_value(f.get_db_prep_save(f.pre_save(obj, True), connection))
+                for f in fields
+            ))
+            buffer.write('\n')
+        buffer.seek(0)
+        columns = ', '.join(connection.ops.quote_name(f.column) for f in fields)
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                f'COPY {connection.ops.quote_name(opts.db_table)} ({columns}) '
+                f"FROM STDIN WITH (FORMAT csv, NULL '{_COPY_NULL}')",
+                buffer
+            )
+        return objs
+
+
 class AbstractDiagnostic(models.Model):
     class Meta:
         abstract = True
+
+    objects = DiagnosticQuerySet.as_manager()
+
     severity = models.IntegerField(default=Severity.INFO)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add, diagnostics may be bulk created after the fact.
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
     message = models.CharField(null=True, blank=True, max_length=255)
-    details = models.JSONField(null=True)
+    details = OrjsonJSONField(null=True)
 
 
 class AbstractStepDiagnostic(AbstractDiagnostic):
@@ -0,0 +1,24 @@
+import orjson
+from django.db import models
+
+
+# Non str keys (e.g. ints) are converted to str as stdlib json does.
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+
+class OrjsonJSONField(models.JSONField):
+    """ JSONField (de)serializing with orjson instead of stdlib json """
+
+    def from_db_value(self, value, expression, connection):
+        if not isinstance(value, str) or self.decoder is not None:
+            return super().from_db_value(value, expression, connection)
+        try:
+            return orjson.loads(value)
+        except orjson.JSONDecodeError:
+            return value
+
+    def get_prep_value(self, value):
+        if value is None or self.encoder is not None:
+            return super().get_prep_value(value)
+        return orjson.dumps(value, option=ORJSON_OPTIONS).decode()
+
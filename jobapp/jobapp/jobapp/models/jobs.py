@@ -1,16 +1,18 @@
 import logging
-import abc
 import time
 import functools
+import contextvars
+import orjson
+from collections import defaultdict
+from contextlib import contextmanager
 
 from django.utils import timezone
-from datetime import datetime, timedelta
-from django.db import models
-from typing import Type
+from datetime import timedelta
+from django.db import connection, models, transaction
 
 from .mixins import StepJobMixin, AbstractProgressJobMixin
-from .diagnostics import AbstractDiagnostic, AbstractStepDiagnostic
 from .notifiers import DbUpdateNotifier
+from .fields import OrjsonJSONField, ORJSON_OPTIONS
 from ..exceptions import (
     JobStateError,
     JobFailedError,
@@ -23,8 +25,24 @@ from ..exceptions import (
 logger = logging.getLogger(__name__)
 
 
+_pinned_now = contextvars.ContextVar('pinned_now', default=None)
+
+
 def now():
-    return timezone.now()
+    return _pinned_now.get() or timezone.now()
+
+
+@contextmanager
+def pinned_now():
+    """ now() returns one and the same time within the block """
+    if _pinned_now.get() is not None:
+        yield
+        return
+    token = _pinned_now.set(timezone.now())
+    try:
+        yield
+    finally:
+        _pinned_now.reset(token)
 
 
 class JobStatus(models.IntegerChoices):
@@ -65,6 +83,38 @@ GOOD_STATUSES = (JobStatus.SUCCESS, JobStatus.SUCCESS_WITH_WARNING)
 BAD_STATUSES = (JobStatus.FAILED, JobStatus.ERRORED)
 
 
+def _status_mask(statuses):
+    mask = 0
+    for status in statuses:
+        mask |= 1 << int(status)
+    return mask
+
+
+# Bitmasks for hot membership tests against the raw int job._status,
+# `(mask >> status) & 1` is set when status is in the group.
+_FINAL_STATUS_MASK = _status_mask(FINAL_STATUSES)
+_GOOD_STATUS_MASK = _status_mask(GOOD_STATUSES)
+_BAD_STATUS_MASK = _status_mask(BAD_STATUSES)
+
+# Columns polled by status/progress watchers, see AbstractJob.to_status_dict
+STATUS_DICT_FIELDS = (
+    '_status',
+    '_ui_status',
+    'updated_at',
+    '_progress_done_units',
+    '_progress_total_units',
+    '_percent_progress',
+)
+
+# Postgres NOTIFY channel for cancel requests, see CancelWatcher
+JOB_CANCEL_CHANNEL = 'job_cancel'
+
+# JobStatus value -> UiStatus value, avoids enum lookups on every transition.
+_STATUS_TO_UI = {
+    s.value: UiStatus[s.name].value for s in JobStatus if s.name in UiStatus.__members__
+}
+
+
 # This could be done through model signals however,
 # If there are cases when job wants to
 # 1. Not to update to db but notify
@@ -77,31 +127,90 @@ def notify_update(f):
         try:
            return f(self, *args, **kwargs)
         finally:
-           self.notify()
+           if not self._defer_notify:
+               self.notify()
     return wrapper
 
 
+_STATUS_DIRTY_FIELDS = ('_status', '_ui_status', 'updated_at')
+
+
+class status_transition:
+    """
+    Flat equivalent of a notify_update decorated method only calling
+    update_status(status), for the frequent transitions.
+    """
+    def __init__(self, status):
+        self.status = int(status)
+
+    def __set_name__(self, owner, name):
+        status = self.status
+
+        def transition(self):
+            self.update_status(status)
+            if not self._defer_notify:
+                self.notify()
+        transition.__name__ = name
+        transition.__qualname__ = '%s.%s' % (owner.__qualname__, name)
+        transition.__module__ = owner.__module__
+        # Replace the descriptor by the plain method once named
+        setattr(owner, name, transition)
+
+
 class AbstractJob(models.Model):
 
     DEFAULT_TTL_THRESHOLD = (3 * 24 * 60 * 60) # 3 days
+    # DbUpdateNotifier is stateless, share one instance between all jobs.
+    DEFAULT_NOTIFIERS = (DbUpdateNotifier(),)
+    # Reverse relation of the diagnostics model of concrete jobs, if any.
+    DIAGNOSTICS_RELATED_NAME = 'diagnostics'
+    DIAGNOSTICS_BATCH_SIZE = 1000
+    # Columns written as increments, see db_update_value()
+    INCREMENT_FIELDS = ()
+    _expiry_key = None
+    # Set while the job is registered with a CancelWatcher
+    _cancel_event = None
+    _cancel_watcher = None
+    # Set while notify_update transitions should not notify, see
+    # batched_notifications()
+    _defer_notify = False
 
     class Meta:
         abstract = True
 
     _status = models.IntegerField(null=True, default=JobStatus.PENDING)
     _ui_status = models.CharField(choices=UiStatus.choices, max_length=255)
-    _data = models.JSONField(null=True)
+    _data = OrjsonJSONField(null=True)
     type = models.IntegerField(null=True)
     created_by = models.CharField(max_length=255)
     description = models.TextField(null=True, blank=True)
     created_at =  models.DateTimeField(auto_now_add=True)
     updated_at =  models.DateTimeField(auto_now_add=True)
     ttl = models.IntegerField(default=DEFAULT_TTL_THRESHOLD)
+    # Highest severity of diagnostics of the job, kept up to date by
+    # add_diagnostic() and saved along with the next notify.
+    _max_diagnostic_severity = models.IntegerField(null=True)
+
+    @classmethod
+    def default_indexes(cls):
+        # Abstract Meta is not inherited by concrete jobs having their own
+        # Meta (or other abstract bases), hence concrete job models should
+        # use these in their Meta.indexes.
+        return [
+            models.Index(fields=['type', '_status'], name='%(class)s_type_status_idx'),
+            # Queue scans, e.g. oldest PENDING jobs first. Kept to this one
+            # on created_at, none on updated_at: the row is updated on every
+            # progress flush and that column should not block HOT updates.
+            models.Index(fields=['_status', 'created_at'], name='%(class)s_status_created_idx'),
+        ]
 
     def __init__(self, *args, notifiers=None, **kwargs):
         super().__init__(*args, **kwargs)
-        if not notifiers:
-            self._notifiers = (DbUpdateNotifier(),)
+        self._notifiers = notifiers or self.DEFAULT_NOTIFIERS
+        self._pending_diagnostics = []
+        # Highest severity of added diagnostics by their stage
+        self._stage_diagnostic_severities = {}
+        self._dirty_fields = set()
 
     @property
     def data(self):
@@ -115,59 +224,115 @@ class AbstractJob(models.Model):
     def ui_status(self):
         return self._ui_status
 
-    @notify_update
-    def acknowledge(self):
-        self.update_status(status=JobStatus.REQUEST_ACK)
+    acknowledge = status_transition(JobStatus.REQUEST_ACK)
 
-    @notify_update
-    def running(self):
-        self.update_status(status=JobStatus.RUNNING)
+    running = status_transition(JobStatus.RUNNING)
 
-    @notify_update
     def fail(self, raise_error=True, reason=''):
+        # Straight line equivalent of notify_update, notify before raising.
         self.update_status(status=JobStatus.FAILED)
+        if not self._defer_notify:
+            self.notify()
         if raise_error:
             raise JobFailedError(f'Job failed, reason={reason}')
 
-    @notify_update
-    def success(self):
-        self.update_status(status=JobStatus.SUCCESS)
+    success = status_transition(JobStatus.SUCCESS)
 
-    @notify_update
-    def error(self):
-        self.update_status(status=JobStatus.ERRORED)
+    error = status_transition(JobStatus.ERRORED)
 
-    @notify_update
     def cancel(self, raise_error=True, reason=''):
-        self.update_status(status=JobStatus.FAILED)
+        self.update_status(status=JobStatus.CANCELED)
+        if not self._defer_notify:
+            self.notify()
         if raise_error:
             raise JobCanceledError(f'Job canceled')
 
-    @notify_update
-    def success_with_warning(self):
-        self.update_status(status=JobStatus.SUCCESS_WITH_WARNING)
+    success_with_warning = status_transition(JobStatus.SUCCESS_WITH_WARNING)
 
-    @notify_update
     def request_cancel(self):
-        self.update_status(JobStatus.REQUEST_CANCEL)
+        # The NOTIFY is delivered to listeners only once the status commits.
+        with transaction.atomic():
+            self.update_status(JobStatus.CANCEL_REQUESTED)
+            if not self._defer_notify:
+                self.notify()
+            self.publish_cancel_request()
+
+    @property
+    def cancel_request_payload(self):
+        model = self._meta.get_field('_status').model
+        return f'{model._meta.label_lower}:{self.pk}'
+
+    def publish_cancel_request(self):
+        if self.pk is None or connection.vendor != 'postgresql':
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_notify(%s, %s)',
+                [JOB_CANCEL_CHANNEL, self.cancel_request_payload]
+            )
 
     def update_status(self, status: JobStatus, ui_status: UiStatus=None):
         assert status or ui_status
-        self._status = status.value
+        if status is not None:
+            status = int(status)
+            self._status = status
         if ui_status is not None:
-            self._ui_status = ui_status.value
+            self._ui_status = UiStatus(ui_status).value
         else:
-            mapped_status = getattr(UiStatus, status.name, None)
-            if mapped_status is not None:
-                self.update_ui_status(mapped_status)
-        self.touch()
+            self._ui_status = _STATUS_TO_UI.get(status, self._ui_status)
+        # Single now() for status, ui status and touch
+        self.updated_at = now()
+        self._dirty_fields.update(_STATUS_DIRTY_FIELDS)
+
+    @classmethod
+    def bulk_update_status(cls, jobs, status: JobStatus, batch_size=1000):
+        """
+        Set status of many saved jobs with bulk UPDATEs, e.g. for a scheduler
+        finalizing a batch of jobs. Notifiers and post job hooks are not run.
+        """
+        for job in jobs:
+            job.update_status(status)
+            job._dirty_fields.difference_update(_STATUS_DIRTY_FIELDS)
+        model = cls._meta.get_field('_status').model
+        model._base_manager.bulk_update(jobs, _STATUS_DIRTY_FIELDS, batch_size=batch_size)
 
     def update_ui_status(self, status: UiStatus):
-        self._ui_status = status
-        self.touch()
+        self.update_status(None, ui_status=status)
 
     def touch(self):
         self.updated_at = now()
+        self.mark_dirty('updated_at')
+
+    def mark_dirty(self, *field_names):
+        # Tracked so that notifiers write only the changed columns
+        self._dirty_fields.update(field_names)
+
+    def pop_dirty_fields(self):
+        dirty_fields, self._dirty_fields = self._dirty_fields, set()
+        return dirty_fields
+
+    def db_update_value(self, field):
+        # Value notifiers write for the field, e.g. an F() increment for
+        # INCREMENT_FIELDS. Pending increments are handed out once.
+        return getattr(self, field.attname)
+
+    def whole_row_update_fields(self):
+        # For saving the whole row of a saved job, INCREMENT_FIELDS are left
+        # to their increments so that other workers' are not overwritten.
+        return [
+            f.name for f in self._meta.concrete_fields
+            if not f.primary_key and f.attname not in self.INCREMENT_FIELDS
+        ]
+
+    def fast_update(self, field_names):
+        # Plain UPDATE of the given fields, one per table owning them (MTI),
+        # without save() and its signals.
+        values_by_model = defaultdict(dict)
+        for name in field_names:
+            field = self._meta.get_field(name)
+            values_by_model[field.model][field.attname] = self.db_update_value(field)
+        for model, values in values_by_model.items():
+            model._base_manager.filter(pk=self.pk).update(**values)
 
     @property
     def notifiers(self):
@@ -176,50 +341,171 @@ class AbstractJob(models.Model):
     def notify(self):
         # notifiers are classes which implemets 'notify' method.
         # and accepts job as first argument
-        for notifier in self.notifiers:
+        notifiers = self._notifiers
+        if len(notifiers) == 1:
+            # Fast path, the default is a single DbUpdateNotifier
+            notifiers[0].notify(self)
+            return
+        for notifier in notifiers:
             notifier.notify(self)
 
+    @contextmanager
+    def batched_notifications(self):
+        # Status transitions inside the block are notified once, on exit.
+        previous, self._defer_notify = self._defer_notify, True
+        try:
+            yield
+        finally:
+            self._defer_notify = previous
+            if not previous:
+                self.notify()
+
+    def flush_notifications(self):
+        # Notifiers may hold back updates (e.g. batching), publish them now.
+        for notifier in self._notifiers:
+            notifier.flush()
+
+    def add_diagnostic(self, **fields):
+        # Buffered, written in bulk by flush_diagnostics()
+        relation = self._meta.get_field(self.DIAGNOSTICS_RELATED_NAME)
+        diagnostic = relation.related_model(**{relation.field.name: self}, **fields)
+        self._pending_diagnostics.append(diagnostic)
+        if self._max_diagnostic_severity is None or diagnostic.severity > self._max_diagnostic_severity:
+            self._max_diagnostic_severity = diagnostic.severity
+            self.mark_dirty('_max_diagnostic_severity')
+        stage = fields.get('stage')
+        stage_severity = self._stage_diagnostic_severities.get(stage)
+        if stage_severity is None or diagnostic.severity > stage_severity:
+            self._stage_diagnostic_severities[stage] = diagnostic.severity
+        if len(self._pending_diagnostics) >= self.DIAGNOSTICS_BATCH_SIZE:
+            # Do not hold diagnostics of e.g. every user of a stage in memory
+            self.flush_diagnostics()
+        return diagnostic
+
+    @property
+    def max_diagnostic_severity(self):
+        # Without a query. Jobs saved before the column existed may be
+        # annotated (diagnostics_max_severity) by the queryset instead.
+        severities = [
+            severity for severity in (
+                self._max_diagnostic_severity,
+                getattr(self, 'diagnostics_max_severity', None),
+            )
+            if severity is not None
+        ]
+        return max(severities) if severities else None
+
+    def max_stage_diagnostic_severity(self, stage):
+        # Like max_diagnostic_severity, but of the given stage only.
+        return self._stage_diagnostic_severities.get(stage)
+
+    def flush_diagnostics(self):
+        if not self._pending_diagnostics:
+            return
+        relation = self._meta.get_field(self.DIAGNOSTICS_RELATED_NAME)
+        pending, self._pending_diagnostics = self._pending_diagnostics, []
+        manager = relation.related_model.objects
+        # COPY for many rows if the diagnostics model supports it
+        bulk_create = getattr(manager, 'bulk_copy', manager.bulk_create)
+        bulk_create(pending, batch_size=self.DIAGNOSTICS_BATCH_SIZE)
+
     def act(self):
         raise NotImplementedError()
 
     def act_resume(self):
         raise NotImplementedError()
 
+    @property
+    def expires_at_ts(self):
+        # Cached unix timestamp, recomputed only if created_at/ttl change.
+        key = (self.created_at, self.ttl)
+        if key != self._expiry_key:
+            self._expiry_key = key
+            self._expires_at_ts = (
+                (self.created_at + timedelta(seconds=self.ttl)).timestamp()
+                if self.created_at is not None else None
+            )
+        return self._expires_at_ts
+
     @property
     def has_expired(self):
-        return not (now() <  self.created_at + timedelta(seconds=self.ttl))
+        expires_at_ts = self.expires_at_ts
+        return expires_at_ts is not None and time.time() >= expires_at_ts
 
     @property
     def is_stale(self):
-        if self.status == JobStatus.PENDING:
+        if self._status == JobStatus.PENDING:
             return False
         return self.has_expired
 
     @property
     def is_running(self):
-        return self.status == JobStatus.RUNNING
+        return self._status == JobStatus.RUNNING
 
     @property
     def is_failed(self):
-        return self.status == JobStatus.FAILED
+        return self._status == JobStatus.FAILED
+
+    @property
+    def is_final(self):
+        return self._status is not None and bool((_FINAL_STATUS_MASK >> self._status) & 1)
 
     @property
     def is_cancel_requested(self, refresh=True):
+        event = self._cancel_event
+        if event is not None:
+            if not event.is_set():
+                self._cancel_watcher.poll_if_due()
+            return event.is_set()
         if refresh:
-            self.refresh()
-        return self.status == JobStatus.CANCEL_REQUESTED
-
-    def refresh(self):
-        self.refresh_from_db()
+            # Single int column of the owning table, local (possibly not
+            # yet notified) state is left as is.
+            return self._fetch_status() == JobStatus.CANCEL_REQUESTED
+        return self._status == JobStatus.CANCEL_REQUESTED
+
+    def check_cancel_requested(self):
+        # Meant for checkpoints like between stages, not tight loops.
+        if self.is_cancel_requested:
+            self.cancel(reason='Cancel requested')
+
+    def _fetch_status(self):
+        # Read only the status column, the row also carries _data.
+        if self.pk is None:
+            return self._status
+        model = self._meta.get_field('_status').model
+        return model._base_manager.filter(pk=self.pk).values_list('_status', flat=True).first()
+
+    def refresh_status(self):
+        self.flush_notifications()
+        self.refresh_from_db(fields=['_status', '_ui_status'])
+
+    def refresh(self, fields=None):
+        # Do not let pending notifications get overwritten by db state.
+        self.flush_notifications()
+        self.refresh_from_db(fields=fields)
 
     def delay(self):
         raise NotImplementedError()
 
     def to_dict(self):
+        # From the instance itself, see to_dict_fresh() for the db state.
+        return {f.attname: getattr(self, f.attname) for f in self._meta.concrete_fields}
+
+    def to_dict_fresh(self):
+        # Like to_dict but as currently in db, e.g. after concurrent updates.
         return type(self).objects.filter(pk=self.pk).values().first()
+
+    def to_status_dict(self):
+        # Like to_dict but without the potentially large _data
+        field_names = {f.name for f in self._meta.concrete_fields}
+        return type(self).objects.filter(pk=self.pk).values(
+            *(f for f in STATUS_DICT_FIELDS if f in field_names)
+        ).first()
     
     def to_message(self):
-        return self.to_message()
+        # orjson bytes of to_dict(), not cached as fields may be assigned
+        # or mutated directly.
+        return orjson.dumps(self.to_dict(), option=ORJSON_OPTIONS)
 
     def on_success(self):
         pass
@@ -230,38 +516,74 @@ class AbstractJob(models.Model):
     def finalize(self):
         pass
 
+    @property
+    def cancel_watcher(self):
+        # Shared by all jobs run by the process
+        from ..watchers import cancel_watcher
+        return cancel_watcher
+
     def run(self):
-        self.acknowledge()
+        # Saved jobs are watched while running, so that cancel checks of
+        # jobs run concurrently are batched.
+        if self.pk is None:
+            return self._run()
+        watcher = self.cancel_watcher
+        watcher.register(self)
         try:
-            if self.is_cancel_requested:
-                self.cancel()
-            else:
-                self.running()
+            return self._run()
+        finally:
+            watcher.unregister(self)
+
+    def _run(self):
+        # Check before acknowledge() as it would overwrite a cancel request.
+        cancel_requested = self.is_cancel_requested
+        # Like batched_notifications(), but the final notify has to be part
+        # of the terminal transaction below. Only RUNNING is notified
+        # in between so that the job is seen running.
+        self._defer_notify = True
+        try:
+            with pinned_now():
+                self.acknowledge()
+                if cancel_requested:
+                    self.cancel()
+                else:
+                    self.running()
+                    self.notify()
+            if not cancel_requested:
                 self.act()
         except (JobFailedError, JobStageFailedError, JobStepFailedError) as e:
-            if self.status != JobStatus.FAILED:
+            if self._status != JobStatus.FAILED:
                 self.fail(raise_error=False, reason=e.args[0])
         except JobCanceledError as e:
-            if self.status != JobStatus.CANCELED:
+            if self._status != JobStatus.CANCELED:
                 self.cancel(raise_error=False, reason=e.args[0])
         except (Exception, JobStateError) as e:
             logger.exception(e)
             self.error()
         else:
-            if self.status not in FINAL_STATUSES:
+            if not (_FINAL_STATUS_MASK >> self._status) & 1:
                 self.success()
         finally:
-            try:
-                self._process_post_job_hooks()
-            except Exception as e:
-                logger.exception(e)
-                self.success_with_warning()
+            # Post job hooks and pending (batched) notifications, including
+            # the terminal status, are committed together.
+            with pinned_now(), transaction.atomic():
+                try:
+                    self._process_post_job_hooks()
+                except Exception as e:
+                    logger.exception(e)
+                    self.success_with_warning()
+                finally:
+                    self._defer_notify = False
+                    self.notify()
+                    self.flush_diagnostics()
+                    self.flush_notifications()
 
     def _process_post_job_hooks(self):
         try:
-            if self.status in GOOD_STATUSES:
+            status = self._status
+            if (_GOOD_STATUS_MASK >> status) & 1:
                 self.on_success()
-            if self.status in BAD_STATUSES:
+            elif (_BAD_STATUS_MASK >> status) & 1:
                 self.on_failure()
         finally:
             self.finalize()
@@ -271,6 +593,26 @@ class AbstractProgressJob(AbstractJob, AbstractProgressJobMixin):
     class Meta:
         abstract = True
 
+    # Concurrent workers may report progress of the same job
+    INCREMENT_FIELDS = ('_progress_done_units',)
+
+    def notify(self):
+        self.flush_progress()
+        super().notify()
+
+    def db_update_value(self, field):
+        if field.attname == '_progress_done_units':
+            units, self._progress_units_unwritten = self._progress_units_unwritten, 0
+            return models.F('_progress_done_units') + units
+        return super().db_update_value(field)
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        super().save(*args, **kwargs)
+        if update_fields is None or '_progress_done_units' in update_fields:
+            # Written as is, including the pending increment
+            self._progress_units_unwritten = 0
+
 
 class AbstractStepJob(AbstractJob, StepJobMixin):
     class Meta:
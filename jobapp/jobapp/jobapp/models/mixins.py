@@ -1,8 +1,12 @@
+import logging
+import time
 from django.db import  models
-from contextlib import contextmanager
 from ..exceptions import JobStateError, JobStageFailedError, JobStepFailedError
 
 
+logger = logging.getLogger(__name__)
+
+
 class AbstractProgressJobMixin(models.Model):
     class Meta:
         abstract = True
@@ -10,22 +14,62 @@ class AbstractProgressJobMixin(models.Model):
     _progress_done_units = models.IntegerField(default=0)
     _percent_progress = models.IntegerField(null=True)
 
+    # Notify at most every N units or T seconds while progressing.
+    PROGRESS_NOTIFY_UNITS = 10
+    PROGRESS_NOTIFY_INTERVAL = 0.25
+    _progress_units_since_notify = 0
+    # Added but not yet folded into _progress_done_units
+    _progress_units_unsaved = 0
+    # Folded but not yet written (as an increment) by notifiers
+    _progress_units_unwritten = 0
+    _progress_notified_at = 0.0
+
     @property
     def progress_total_units(self):
         return self._progress_total_units
 
     @property
     def progress_done_units(self):
-        return self._progress_done_units
+        return self._progress_done_units + self._progress_units_unsaved
 
     def add_progress_total_units(self, units):
         self._progress_total_units += units
+        self.mark_dirty('_progress_total_units')
 
     def add_progress_done_units(self, units, notify=True):
-        self._progress_done_units += units
-        if notify:
+        # Plain int accumulator, folded into the model field and persisted
+        # by flush_progress() on notify, not per tick.
+        self._progress_units_unsaved += units
+        if notify and self._should_notify_progress(units):
             self.notify()
 
+    def flush_progress(self):
+        units, self._progress_units_unsaved = self._progress_units_unsaved, 0
+        if not units:
+            return
+        self._progress_done_units += units
+        # Notifiers write it as an atomic increment along with the other
+        # dirty columns, concurrent workers reporting progress for same job
+        # do not clobber it.
+        self._progress_units_unwritten += units
+        self.mark_dirty('_progress_done_units')
+        self.touch()
+
+    def _should_notify_progress(self, units):
+        self._progress_units_since_notify += units
+        now = time.monotonic()
+        total, done = self.progress_total_units, self.progress_done_units
+        if (
+            self._progress_units_since_notify >= self.PROGRESS_NOTIFY_UNITS
+            or now - self._progress_notified_at >= self.PROGRESS_NOTIFY_INTERVAL
+            # Just completed, not every tick without a total or past it
+            or 0 < total <= done < total + units
+        ):
+            self._progress_units_since_notify = 0
+            self._progress_notified_at = now
+            return True
+        return False
+
     @property
     def remaining_progress_units(self):
         return self.progress_total_units - self.progress_done_units
@@ -42,6 +86,83 @@ class AbstractProgressJobMixin(models.Model):
     def percent_progress(self, value: int):
         assert 0 <= value <= 100
         self._percent_progress = value
+        self.mark_dirty('_percent_progress')
+
+
+# Plain classes rather than @contextmanager generators, these are entered
+# for every step of a job.
+class _StepContext:
+    __slots__ = ('job', 'step', 'data')
+
+    def __init__(self, job, step, data):
+        self.job = job
+        self.step = step
+        self.data = data
+
+    def __enter__(self):
+        job = self.job
+        job.current_step = self.step
+        job.current_step_data = self.data
+        job.on_step_start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        job = self.job
+        try:
+            if exc_type is None:
+                job.on_step_success()
+            elif issubclass(exc_type, Exception):
+                if not issubclass(exc_type, JobStateError):
+                    logger.error('Step %s failed', job.current_step, exc_info=(exc_type, exc, tb))
+                job.current_step_data.update(
+                    {'error': str(exc) }
+                )
+                job.on_step_fail()
+        finally:
+            job.on_step_end()
+            job.current_step = None
+            job.current_step_data = None
+        return False
+
+
+class _StageContext:
+    __slots__ = ('job', 'stage', 'data')
+
+    def __init__(self, job, stage, data):
+        self.job = job
+        self.stage = stage
+        self.data = data
+
+    def __enter__(self):
+        job = self.job
+        job.current_stage = self.stage
+        job.current_stage_data = self.data
+        job.on_stage_start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        job = self.job
+        try:
+            if exc_type is None:
+                job.on_stage_success()
+            elif issubclass(exc_type, JobStateError):
+                job.current_stage_data.update(
+                    {'error': str(exc)}
+                )
+                job.on_stage_fail()
+                # Failed stage does not fail the job
+                return True
+            elif issubclass(exc_type, Exception):
+                logger.error('Stage %s failed', job.current_stage, exc_info=(exc_type, exc, tb))
+                job.current_stage_data.update(
+                    {'error': 'Something went wrong'}
+                )
+                job.on_stage_fail()
+        finally:
+            job.on_stage_end()
+            job.current_stage = None
+            job.current_stage_data = None
+        return False
 
 
 class StepJobMixin:
@@ -64,32 +185,8 @@ class StepJobMixin:
     def on_step_fail(self):
         pass
 
-    @contextmanager
     def step_context(self, step, **data):
-        self.current_step = step
-        self.current_step_data = data
-        self.on_step_start()
-        try:
-            yield
-        except JobStateError as e:
-            self.current_step_data.update(
-                {'error': str(e) }
-            )
-            self.on_step_fail()
-            raise          
-        except Exception as e:
-            print(e)
-            self.current_step_data.update(
-                {'error': str(e) }
-            )
-            self.on_step_fail()
-            raise
-        else:
-            self.on_step_success()
-        finally:
-            self.on_step_end()
-            self.current_step = None
-            self.current_step_data = None
+        return _StepContext(self, step, data)
 
     StepContext = step_context
 
@@ -111,30 +208,7 @@ class StepJobMixin:
     def on_stage_fail(self):
         pass
 
-    @contextmanager
     def stage_context(self, stage, **data):
-        self.current_stage = stage
-        self.current_stage_data = data
-        self.on_stage_start()
-        try:
-            yield
-        except JobStateError as e:
-            self.current_stage_data.update(
-                {'error': str(e)}
-            )
-            self.on_stage_fail()
-        except Exception as e:
-            print(e)
-            self.current_stage_data.update(
-                {'error': 'Something went wrong'}
-            )
-            self.on_stage_fail()
-            raise
-        else:
-            self.on_stage_success()
-        finally:
-            self.on_stage_end()
-            self.current_stage = None
-            self.current_stage_data = None
+        return _StageContext(self, stage, data)
 
     StageContext = stage_context
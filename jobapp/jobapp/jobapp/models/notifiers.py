@@ -1,12 +1,111 @@
 import  abc
+import time
+import threading
+from collections import defaultdict
+
+from django.db import transaction
+
 
 class AbstractJobNotifier(abc.ABC):
     @abc.abstractmethod
     def notify(self, job):
         ...
 
+    def flush(self):
+        """ Publish anything held back by notify(), no-op by default """
+        pass
+
 
 class DbUpdateNotifier(AbstractJobNotifier):
     """ Simply save the job state to db """
     def notify(self, job):
-        job.save()
\ No newline at end of file
+        # Only the changed columns, whole row if nothing tracked or new job
+        # (but for columns only written as increments).
+        dirty_fields = job.pop_dirty_fields()
+        if job._state.adding:
+            job.save()
+        elif not dirty_fields:
+            job.save(update_fields=job.whole_row_update_fields())
+        else:
+            job.fast_update(dirty_fields)
+
+
+class BatchedDbUpdateNotifier(AbstractJobNotifier):
+    """
+    Coalesce job state saves per thread and write them with bulk_update,
+    once flush_interval seconds have passed since last write or on flush().
+
+    Only the columns marked dirty by the jobs are written, UPDATE_FIELDS if
+    a job did not track any.
+    """
+    UPDATE_FIELDS = (
+        '_status',
+        '_ui_status',
+        'updated_at',
+        '_progress_total_units',
+        '_progress_done_units',
+        '_percent_progress',
+    )
+
+    def __init__(self, flush_interval=1.0, batch_size=500):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._local = threading.local()
+
+    @property
+    def _pending(self):
+        if not hasattr(self._local, 'pending'):
+            self._local.pending = {}
+            self._local.last_flush = time.monotonic()
+        return self._local.pending
+
+    def notify(self, job):
+        if job._state.adding:
+            # bulk_update can not insert, save new jobs right away.
+            job.save()
+            return
+        dirty_fields = job.pop_dirty_fields() or set(self.UPDATE_FIELDS)
+        key = (type(job), job.pk)
+        if key in self._pending:
+            dirty_fields |= self._pending[key][1]
+        self._pending[key] = (job, dirty_fields)
+        if time.monotonic() - self._local.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        pending = self._pending
+        self._local.last_flush = time.monotonic()
+        if not pending:
+            return
+        jobs_by_model = defaultdict(list)
+        fields_by_model = defaultdict(set)
+        for (model, _), (job, dirty_fields) in pending.items():
+            jobs_by_model[model].append(job)
+            fields_by_model[model] |= dirty_fields
+        pending.clear()
+        with transaction.atomic():
+            for model, jobs in jobs_by_model.items():
+                field_names = {f.name for f in model._meta.concrete_fields}
+                fields = [
+                    model._meta.get_field(f) for f in fields_by_model[model]
+                    if f in field_names
+                ]
+                # bulk_update writes expressions (e.g. progress increments)
+                # set on the jobs, the values are put back afterwards.
+                replaced = []
+                for job in jobs:
+                    for field in fields:
+                        value = getattr(job, field.attname)
+                        db_value = job.db_update_value(field)
+                        if db_value is not value:
+                            replaced.append((job, field.attname, value))
+                            setattr(job, field.attname, db_value)
+                try:
+                    model._base_manager.bulk_update(
+                        jobs,
+                        [field.name for field in fields],
+                        batch_size=self.batch_size
+                    )
+                finally:
+                    for job, attname, value in replaced:
+                        setattr(job, attname, value)
@@ -1,3 +1,114 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from .models import OrjsonJSONField
+from .exceptions import JobStepFailedError
+from .models import JobStatus, UiStatus, FINAL_STATUSES, GOOD_STATUSES, BAD_STATUSES
+from .models.mixins import StepJobMixin
+from .models.diagnostics import _copy_csv_value
+from .models.jobs import (
+    _STATUS_TO_UI,
+    _FINAL_STATUS_MASK,
+    _GOOD_STATUS_MASK,
+    _BAD_STATUS_MASK,
+    now,
+    pinned_now,
+)
+
+
+class TestOrjsonJSONField(SimpleTestCase):
+
+    def test_round_trip(self):
+        field = OrjsonJSONField(null=True)
+        value = {'data': {'username': 'user', 'user_id': 1}, 2: [1.5, None]}
+        prepared = field.get_prep_value(value)
+        self.assertIsInstance(prepared, str)
+        self.assertEqual(
+            field.from_db_value(prepared, None, None),
+            {'data': {'username': 'user', 'user_id': 1}, '2': [1.5, None]}
+        )
+
+
+class TestPinnedNow(SimpleTestCase):
+
+    def test_same_now_within_block(self):
+        with pinned_now():
+            pinned = now()
+            with pinned_now():
+                self.assertEqual(now(), pinned)
+            self.assertEqual(now(), pinned)
+        self.assertNotEqual(now(), pinned)
+
+
+class TestStatusToUi(SimpleTestCase):
+
+    def test_statuses_map_to_same_named_ui_status(self):
+        for status in JobStatus:
+            if status.name in UiStatus.__members__:
+                self.assertEqual(_STATUS_TO_UI[status], UiStatus[status.name])
+            else:
+                self.assertNotIn(status, _STATUS_TO_UI)
+
+
+class TestStatusMasks(SimpleTestCase):
+
+    def test_masks_match_status_tuples(self):
+        for mask, statuses in (
+            (_FINAL_STATUS_MASK, FINAL_STATUSES),
+            (_GOOD_STATUS_MASK, GOOD_STATUSES),
+            (_BAD_STATUS_MASK, BAD_STATUSES),
+        ):
+            for status in JobStatus:
+                self.assertEqual(bool((mask >> status) & 1), status in statuses)
+
+
+class _Steps(StepJobMixin):
+
+    def __init__(self):
+        super().__init__()
+        self.events = []
+
+    def on_step_success(self):
+        self.events.append(('step_success', self.current_step))
+
+    def on_step_fail(self):
+        self.events.append(('step_fail', self.current_step, self.current_step_data['error']))
+
+    def on_stage_fail(self):
+        self.events.append(('stage_fail', self.current_stage, self.current_stage_data['error']))
+
+
+class TestStepContexts(SimpleTestCase):
+
+    def test_step_success_and_fail(self):
+        job = _Steps()
+        with job.StepContext('A'):
+            pass
+        with self.assertRaises(JobStepFailedError):
+            with job.StepContext('B'):
+                job.fail_step('no')
+        self.assertEqual(job.events, [('step_success', 'A'), ('step_fail', 'B', 'no')])
+        self.assertIsNone(job.current_step)
+        self.assertIsNone(job.current_step_data)
+
+    def test_stage_swallows_job_state_errors(self):
+        job = _Steps()
+        with job.StageContext('S'):
+            job.fail_stage('bad')
+        with self.assertRaises(ValueError):
+            with job.StageContext('T'):
+                raise ValueError('boom')
+        self.assertEqual(job.events, [
+            ('stage_fail', 'S', 'bad'),
+            ('stage_fail', 'T', 'Something went wrong'),
+        ])
+        self.assertIsNone(job.current_stage)
+
+
+class TestCopyCsvValue(SimpleTestCase):
+
+    def test_null_is_unquoted_marker(self):
+        self.assertEqual(_copy_csv_value(None), r'\N')
+        self.assertEqual(_copy_csv_value(''), '""')
+        self.assertEqual(_copy_csv_value(r'\N'), r'"\N"')
+        self.assertEqual(_copy_csv_value('a,"b"'), '"a,""b"""')
+        self.assertEqual(_copy_csv_value(3), '"3"')
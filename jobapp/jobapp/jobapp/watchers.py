@@ -0,0 +1,161 @@
+import logging
+import select
+import threading
+import time
+from collections import defaultdict
+
+from django.apps import apps
+from django.db import connection
+
+from .models import JobStatus
+from .models.jobs import JOB_CANCEL_CHANNEL
+
+
+logger = logging.getLogger(__name__)
+
+
+class CancelWatcher:
+    """
+    Watch many in-flight jobs for cancel requests with one query per job
+    model per poll, instead of every job refreshing itself from db.
+
+    Registered jobs answer is_cancel_requested from an in-memory event.
+    Jobs register themselves for the time they run, see AbstractJob.run().
+
+    Until start()ed, registered jobs checking for a cancel request poll
+    for all of them, at most once per interval. Once started, on postgres
+    the watcher thread LISTENs for the NOTIFY sent by request_cancel() and
+    polls only once when it starts listening, or falls back to polling if
+    listening fails.
+    """
+    def __init__(self, interval=0.5, listen=True):
+        self.interval = interval
+        self.listen = listen
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._polled_at = time.monotonic()
+
+    @staticmethod
+    def _key(job):
+        # The model owning _status, so MTI jobs are polled without joins.
+        return job._meta.get_field('_status').model, job.pk
+
+    def register(self, job):
+        assert job.pk is not None, 'Only saved jobs can be watched'
+        event = threading.Event()
+        job._cancel_event = event
+        job._cancel_watcher = self
+        with self._lock:
+            self._jobs[self._key(job)] = job
+        # Cancel requested before the job was watched, checked once
+        # registered so that none is missed in between.
+        if job._fetch_status() == JobStatus.CANCEL_REQUESTED:
+            event.set()
+
+    def unregister(self, job):
+        with self._lock:
+            self._jobs.pop(self._key(job), None)
+        job._cancel_event = None
+        job._cancel_watcher = None
+
+    def poll_if_due(self):
+        # Inline polling while there is no watcher thread
+        if self._thread is not None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if now - self._polled_at < self.interval:
+                return
+            self._polled_at = now
+        self.poll()
+
+    def poll(self):
+        with self._lock:
+            jobs = dict(self._jobs)
+        pks_by_model = defaultdict(list)
+        for model, pk in jobs:
+            pks_by_model[model].append(pk)
+        canceled = set()
+        for model, pks in pks_by_model.items():
+            canceled_pks = model._base_manager.filter(
+                pk__in=pks,
+                _status=JobStatus.CANCEL_REQUESTED
+            ).values_list('pk', flat=True)
+            for pk in canceled_pks:
+                jobs[(model, pk)]._cancel_event.set()
+                canceled.add(jobs[(model, pk)])
+        return canceled
+
+    def handle_payload(self, payload):
+        # payload is AbstractJob.cancel_request_payload
+        label, pk = payload.rsplit(':', 1)
+        model = apps.get_model(label)
+        with self._lock:
+            job = self._jobs.get((model, model._meta.pk.to_python(pk)))
+        if job is not None and job._cancel_event is not None:
+            job._cancel_event.set()
+        return job
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            name='job-cancel-watcher',
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        try:
+            if self.listen and connection.vendor == 'postgresql':
+                try:
+                    self._listen()
+                except Exception as e:
+                    # e.g. connection lost, registered jobs keep seeing
+                    # cancels by polling (on a new connection) instead.
+                    logger.exception(e)
+                    connection.close()
+                    self._poll()
+            else:
+                self._poll()
+        finally:
+            # Thread has its own db connection
+            connection.close()
+
+    def _poll(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as e:
+                logger.exception(e)
+
+    def _listen(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'LISTEN {JOB_CANCEL_CHANNEL}')
+        pg_connection = connection.connection
+        # Cancel requested before listening
+        self.poll()
+        while not self._stop.is_set():
+            if not select.select([pg_connection], [], [], self.interval)[0]:
+                continue
+            pg_connection.poll()
+            while pg_connection.notifies:
+                notification = pg_connection.notifies.pop(0)
+                try:
+                    self.handle_payload(notification.payload)
+                except Exception as e:
+                    logger.exception(e)
+
+
+cancel_watcher = CancelWatcher()
@@ -0,0 +1,21 @@
+# Generated by Django 3.1.1 on 2026-10-16 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest_api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['type', '_status'], name='job_type_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['_status', 'created_at'], name='job_status_created_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.1.1 on 2026-10-16 11:02
+
+from django.db import migrations
+import jobapp.jobapp.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest_api', '0002_job_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='job',
+            name='_data',
+            field=jobapp.jobapp.models.fields.OrjsonJSONField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='jobdiagnostic',
+            name='details',
+            field=jobapp.jobapp.models.fields.OrjsonJSONField(null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.1.1 on 2026-10-16 11:40
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest_api', '0003_orjson_json_fields'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='jobdiagnostic',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 3.1.1 on 2026-10-16 12:25
+
+from django.db import migrations
+import jobapp.rest_api.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest_api', '0004_jobdiagnostic_created_at_default'),
+    ]
+
+    operations = [
+        migrations.AlterModelManagers(
+            name='user',
+            managers=[
+                ('objects', jobapp.rest_api.models.UserManager()),
+            ],
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 3.1.1 on 2026-10-16 14:05
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    # Build the index without locking the job table for writes
+    atomic = False
+
+    dependencies = [
+        ('rest_api', '0005_user_managers'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='job',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['_data'], name='job_data_gin_idx', opclasses=['jsonb_path_ops']),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.1 on 2026-10-16 15:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rest_api', '0006_job_data_gin_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='_max_diagnostic_severity',
+            field=models.IntegerField(null=True),
+        ),
+    ]
@@ -1,58 +1,81 @@
 import logging
-import abc
 import time
-import enum
 from django.db import transaction
 from django.db import models
-from jobapp.jobapp.exceptions import (
-    JobStepFailedError,
-    JobStageFailedError,
-    JobFailedError
-)
+from jobapp.jobapp.exceptions import JobStepFailedError
 from jobapp.jobapp.models import (
     AbstractStepProgressJob,
     AbstractStepDiagnostic,
     Severity,
     JobStatus,
 )
-from django.db.models import Max
 from django.contrib.auth.models import AbstractUser
+from django.contrib.auth.models import UserManager as DjangoUserManager
 from django.contrib.auth.models import Group
-from django.db.models import Count
+from django.contrib.postgres.indexes import GinIndex
+from django.utils.functional import cached_property
 from polymorphic.models import PolymorphicModel, PolymorphicManager
+from polymorphic.query import PolymorphicQuerySet
 
 
 logger = logging.getLogger(__name__)
 
 ############### DEMO ###########
 
+class UserQuerySet(models.QuerySet):
+    def with_effective_groups(self):
+        # Everything effective_groups needs, in 3 queries for all users.
+        return self.prefetch_related('groups', 'groupsets__groups')
+
+
+class UserManager(DjangoUserManager.from_queryset(UserQuerySet)):
+    pass
+
+
 class User(AbstractUser):
+    objects = UserManager()
 
     def sync_with_idp(self):
         time.sleep(0.5)
-        print(f"{self} - Successfully synced with okta.")
+        logger.info('%s - Successfully synced with okta.', self)
 
-    @property
+    @classmethod
+    def bulk_sync_with_idp(cls, users):
+        # Single bulk membership call for all given users.
+        time.sleep(0.5)
+        logger.info('%d users - Successfully synced with okta.', len(users))
+
+    # Group properties below are cached per instance, fetch the user again
+    # to see membership changes.
+    @cached_property
     def direct_group_names(self):
         return { g.name for g in self.groups.all() }
 
-    @property
+    @cached_property
     def groupset_groups(self):
-        for gs in self.groupsets.prefetch_related('groups'):
-            for g in gs.groups.all():
-                yield g
+        groupsets = self.groupsets.all()
+        if 'groupsets' not in getattr(self, '_prefetched_objects_cache', {}):
+            groupsets = groupsets.prefetch_related('groups')
+        return [g for gs in groupsets for g in gs.groups.all()]
 
-    @property
+    @cached_property
     def groupsets_groups_names(self):
         return { g.name for g in self.groupset_groups }
 
-    @property
+    @cached_property
     def effective_groups(self):
-        return list(self.groups.all()) +  list(self.groupset_groups)
+        return list(self.groups.all()) + self.groupset_groups
 
-    @property
+    @cached_property
     def effective_group_names(self):
-        return { g.name for g in self.effective_groups }
+        prefetched = getattr(self, '_prefetched_objects_cache', {})
+        if 'groups' in prefetched and 'groupsets' in prefetched:
+            return { g.name for g in self.effective_groups }
+        # Direct and groupsets groups in a single query
+        return set(
+            Group.objects.filter(models.Q(user=self) | models.Q(groupsets__users=self))
+            .values_list('name', flat=True)
+        )
 
 
 class Groupset(models.Model):
@@ -62,13 +85,80 @@ class Groupset(models.Model):
 
     @property
     def last_job(self):
-        return self.groupset_jobs.order_by('-updated_at').first()
+        # groupset_id and updated_at live in different (MTI) tables, so no
+        # composite index, but at least the job data is not fetched.
+        return self.groupset_jobs.without_data().order_by('-updated_at').first()
+
+
+
+def _parent_link_paths(model, prefix=''):
+    # Paths to the (MTI) parents of model, e.g. ['job_ptr'] of GroupsetJob
+    paths = []
+    for parent, link in model._meta.concrete_model._meta.parents.items():
+        if link is None:
+            continue
+        path = prefix + link.name
+        paths.append(path)
+        paths.extend(_parent_link_paths(parent, path + '__'))
+    return paths
+
+
+class JobQuerySet(PolymorphicQuerySet):
+    def without_data(self):
+        # For status/progress consumers, _data is loaded on access if needed.
+        return self.defer('_data')
+
+    def with_max_severity(self):
+        # Highest severity of saved diagnostics of every job in one query,
+        # used by max_diagnostic_severity e.g. for listing job statuses.
+        return self.annotate(diagnostics_max_severity=models.Max('diagnostics__severity'))
+
+    def claim_pending(self, limit=1):
+        """
+        Oldest pending jobs, acknowledged for the calling worker. Jobs being
+        claimed by concurrent workers are skipped rather than waited for.
+        """
+        with transaction.atomic():
+            # 'self' locks only the row of the queried model's table, the
+            # parent rows (_status is in Job's) are locked by their links.
+            of = ['self'] + _parent_link_paths(self.model)
+            jobs = list(
+                self.select_for_update(skip_locked=True, of=of)
+                .filter(_status=JobStatus.PENDING)
+                .order_by('created_at')[:limit]
+            )
+            # Through the notifiers, like any other status transition
+            for job in jobs:
+                job.acknowledge()
+        return jobs
+
+
+class JobManager(PolymorphicManager.from_queryset(JobQuerySet)):
+    queryset_class = JobQuerySet
+
+
+class GroupsetJobQuerySet(JobQuerySet):
+    def for_execution(self):
+        # Groupset members act() reads, in 2 queries for all jobs.
+        return self.select_related('groupset').prefetch_related(
+            models.Prefetch('groupset__users', queryset=User.objects.only('id', 'username')),
+            'groupset__groups',
+        )
+
 
+class GroupsetJobManager(PolymorphicManager.from_queryset(GroupsetJobQuerySet)):
+    queryset_class = GroupsetJobQuerySet
 
 
 # Base model for all job model/table
 class Job(PolymorphicModel, AbstractStepProgressJob):
-    pass
+    objects = JobManager()
+
+    class Meta(PolymorphicModel.Meta):
+        indexes = AbstractStepProgressJob.default_indexes() + [
+            # Containment (_data__contains) filters only, smaller than jsonb_ops
+            GinIndex(fields=['_data'], opclasses=['jsonb_path_ops'], name='job_data_gin_idx'),
+        ]
 
  
 # Diagnostics for all jobs
@@ -99,6 +189,8 @@ class GroupsetJob(Job):
         GROUPS_UPDATE = 'GROUPS_UPDATE'
         GROUPSET_DELETE = 'DELETE_GROUPSET'
 
+    objects = GroupsetJobManager()
+
     groupset = models.ForeignKey(
         Groupset,
         on_delete=models.SET_NULL,
@@ -106,9 +198,14 @@ class GroupsetJob(Job):
         related_name='groupset_jobs'
     )
 
+    IDP_SYNC_BATCH_SIZE = 100
+    IDP_SYNC_WORKERS = 4
+    # From this many users, a step covers an idp sync batch, not a user
+    BULK_STEPS_MIN_USERS = 1000
+    MEMBERSHIP_BATCH_SIZE = 1000
+
     def on_step_success(self):    
-        return self.diagnostics.create(
-            job=self,
+        return self.add_diagnostic(
             step=self.current_step,
             stage=self.current_stage,
             message='succceded',
@@ -116,8 +213,7 @@ class GroupsetJob(Job):
         )
 
     def on_step_fail(self):
-        return self.diagnostics.create(
-            job=self,
+        return self.add_diagnostic(
             step=self.current_step,
             stage=self.current_stage,
             severity=Severity.CRITICAL,
@@ -126,20 +222,20 @@ class GroupsetJob(Job):
         )
 
     def on_step_end(self):
-        # Increament progress unit by 1, as it we has processed 1 user.
-        self.add_progress_done_units(1)
-        print(f'Progress: {int(self.percent_progress)}%')
+        # Increament progress unit by 1, as it we has processed 1 user,
+        # or by the users of a batch step.
+        self.add_progress_done_units(self.current_step_data.get('units', 1))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Progress: %d%%', int(self.percent_progress))
 
     def on_stage_success(self):
-        return self.diagnostics.create(
-            job=self,
+        return self.add_diagnostic(
             stage=self.current_stage,
             message='succeeded',
         )
 
     def on_stage_fail(self):
-        self.diagnostics.create(
-            job=self,
+        self.add_diagnostic(
             stage=self.current_stage,
             step=self.current_step,
             severity=Severity.CRITICAL,
@@ -147,88 +243,179 @@ class GroupsetJob(Job):
         )
 
     def on_stage_start(self):
-        return self.diagnostics.create(
-            job=self,
+        return self.add_diagnostic(
             stage=self.current_stage,
             message='started',
         )
 
+    def on_stage_end(self):
+        self.flush_diagnostics()
+
     def _job_status_from_diagnostics(self):
-        if self.diagnostics.filter(severity=Severity.CRITICAL).exists():
+        if self.max_diagnostic_severity == Severity.CRITICAL:
             return JobStatus.FAILED
         return JobStatus.SUCCESS
 
     def _stage_severity_from_diagnostics(self):
-        max_severity = self.diagnostics.aggregate(Max('severity'))['severity__max']
-        if max_severity:
-            return Severity(max_severity)
+        # Of the current stage only, earlier stages are already accounted.
+        severity = self.max_stage_diagnostic_severity(self.current_stage)
+        if severity:
+            return Severity(severity)
         return Severity.INFO
 
-    def add_user(self, user):
+    def add_users(self, users):
+        # Only through table rows change, groupset row itself is untouched.
+        # Inserted directly, users.add() first selects already added users
+        # with an IN of all given ids, e.g. of every user for '*'.
+        through = Groupset.users.through
+        # No savepoint of its own within update_users()' transaction
+        with transaction.atomic(savepoint=False):
+            through.objects.bulk_create(
+                [through(groupset_id=self.groupset_id, user_id=user.id) for user in users],
+                batch_size=self.MEMBERSHIP_BATCH_SIZE,
+                ignore_conflicts=True,
+            )
+
+    def remove_users(self, users, all_users=False):
+        with transaction.atomic(savepoint=False):
+            if all_users:
+                # By groupset only, not with an IN of every member
+                self.groupset.users.clear()
+            else:
+                self.groupset.users.remove(*users)
+
+    def sync_users_with_idp(self, users_by_step):
+        # Idp sync is network bound, sync batches of users of all steps
+        # concurrently (like gathering them) and record the outcome of each
+        # user as a step in order.
+        batch_size = self.IDP_SYNC_BATCH_SIZE
+        batches = [
+            (step, users[i:i + batch_size])
+            for step, users in users_by_step.items()
+            for i in range(0, len(users), batch_size)
+        ]
+        if not batches:
+            return
+        # Jobs changing many users record a step per batch instead.
+        bulk = sum(len(users) for users in users_by_step.values()) >= self.BULK_STEPS_MIN_USERS
+        # Only needed here, not on every import of the models.
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=self.IDP_SYNC_WORKERS) as executor:
+            futures = [
+                (step, batch, executor.submit(User.bulk_sync_with_idp, batch))
+                for step, batch in batches
+            ]
+            for step, batch, future in futures:
+                errors = {}
+                if future.exception() is not None:
+                    # Retried per user, so that only the failing ones fail
+                    retries = [(user, executor.submit(user.sync_with_idp)) for user in batch]
+                    for user, retry in retries:
+                        error = retry.exception()
+                        if error is not None:
+                            errors[user.id] = error
+                if bulk:
+                    steps = [(
+                        dict(data=dict(user_ids=[user.id for user in batch]), units=len(batch)),
+                        f'Failed to sync users {list(errors)} with idp' if errors else None,
+                    )]
+                else:
+                    steps = [
+                        (
+                            dict(data=dict(username=user.username, user_id=user.id)),
+                            f'Failed to sync with idp: {errors[user.id]}' if user.id in errors else None,
+                        )
+                        for user in batch
+                    ]
+                for step_data, failure in steps:
+                    try:
+                        with self.StepContext(step, **step_data):
+                            if failure is not None:
+                                self.fail_step(failure)
+                    except JobStepFailedError:
+                        pass
+
+    def update_users(self, add_users, remove_users, remove_all_users=False):
+        # Single bulk membership change, instead of a transaction per user.
         with transaction.atomic():
-            self.groupset.users.remove(user)
-            self.groupset.save()
-            user.sync_with_idp()
-
-    def remove_user(self, user):
-        with transaction.atomic():
-            self.groupset.users.remove(user)
-            self.groupset.save()
-            user.sync_with_idp()
-
-    def update_users(self, add_users, remove_users):
-        for user in remove_users:
-            try:
-                with self.StepContext(
-                    self.Step.REMOVE_USER,
-                    data=dict(username=user.username, user_id=user.id)
-                ):
-                    self.remove_user(user)
-            except JobStepFailedError as e:
-                pass
-
-        for user in add_users:
-            try:
-                with self.StepContext(
-                    self.Step.ADD_USER,
-                    data=dict(username=user.username, user_id=user.id)
-                ):
-                    self.add_user(user)
-            except JobStepFailedError as e:
-                pass
+            if remove_users:
+                self.remove_users(remove_users, all_users=remove_all_users)
+            if add_users:
+                self.add_users(add_users)
+        self.sync_users_with_idp({
+            self.Step.REMOVE_USER: remove_users,
+            self.Step.ADD_USER: add_users,
+        })
 
     def add_remove_groups(self, add_groups, remove_groups):
+        # Only through table rows change, groupset row itself is untouched.
         with transaction.atomic():
-            self.groupset.groups.add(*add_groups)
-            self.groupset.groups.remove(*remove_groups)
-            self.groupset.save()
+            if add_groups:
+                self.groupset.groups.add(*add_groups)
+            if remove_groups:
+                self.groupset.groups.remove(*remove_groups)
 
     def update_groups(self, add_groups, remove_groups):
         # Only single step i.e. update given groups
         with self.StepContext(self.Step.UPDATE_GROUPS):
             self.add_remove_groups(add_groups, remove_groups)
 
+    def _prefetched_members(self, name, ids, all_members=False):
+        # Groupset members (users/groups) of given ids, or all, if the job
+        # was loaded with for_execution(), else None.
+        groupset = self.groupset
+        if name not in getattr(groupset, '_prefetched_objects_cache', {}):
+            return None
+        related = getattr(groupset, name)
+        members = related.all()
+        if all_members:
+            return list(members)
+        # As id__in would take them, e.g. ids given as strings
+        to_python = related.model._meta.pk.to_python
+        ids = {to_python(id_) for id_ in ids}
+        return [member for member in members if member.pk in ids]
+
     def act(self):
-        add_users = list(
+        # Bound once, not looked up again for every list and wildcard.
+        groupset = self.groupset
+        data = self.data
+        add_user_ids = data.get('add_user_ids', ())
+        remove_user_ids = data.get('remove_user_ids', ())
+        add_group_ids = data.get('add_group_ids', ())
+        remove_group_ids = data.get('remove_group_ids', ())
+        add_all_users = '*' in add_user_ids
+        remove_all_users = '*' in remove_user_ids
+        add_all_groups = '*' in add_group_ids
+        remove_all_groups = '*' in remove_group_ids
+
+        # Only what membership changes and steps use, not e.g. password.
+        # Users are held as a list, every one of them is a step (or part of
+        # an idp sync batch) and counted for progress.
+        add_users = list((
             User.objects.all() # TODO: by tenant
-            if '*' in self.data.get('add_user_ids', [])
-            else User.objects.filter(id__in=self.data.get('add_user_ids', []))
-        )
-        remove_users = list(
-            self.groupset.users # TODO: by tenant
-            if '*' in  self.data.get('remove_user_ids', [])
-            else self.groupset.users.filter(id__in=self.data.get('remove_user_ids', []))
-        )
-        add_groups = list(
+            if add_all_users
+            else User.objects.filter(id__in=add_user_ids)
+        ).only('id', 'username'))
+        remove_users = self._prefetched_members('users', remove_user_ids, remove_all_users)
+        if remove_users is None:
+            remove_users = list((
+                groupset.users.all() # TODO: by tenant
+                if remove_all_users
+                else groupset.users.filter(id__in=remove_user_ids)
+            ).only('id', 'username'))
+        # Groups are only added/removed, by their ids.
+        add_groups = list((
             Group.objects.all() # TODO: by tenant
-            if '*' in self.data.get('add_group_ids', [])
-            else Group.objects.filter(id__in=self.data.get('add_group_ids', []))
-        )
-        remove_groups = list(
-            self.groupset.groups
-            if '*' in self.data.get('remove_group_ids', [])
-            else self.groupset.groups.filter(id__in=self.data.get('remove_group_ids', []))
-        )
+            if add_all_groups
+            else Group.objects.filter(id__in=add_group_ids)
+        ).values_list('id', flat=True))
+        remove_groups = self._prefetched_members('groups', remove_group_ids, remove_all_groups)
+        if remove_groups is None:
+            remove_groups = list((
+                groupset.groups.all()
+                if remove_all_groups
+                else groupset.groups.filter(id__in=remove_group_ids)
+            ).values_list('id', flat=True))
 
         # Calculate and update total units for progress caculations.
         total_units = n_users = len(add_users) + len(remove_users)
@@ -246,18 +433,19 @@ class GroupsetJob(Job):
                     self.fail_stage(f'Failed to update roles')
 
         if n_users:
+            self.check_cancel_requested()
             # Users update stage
             with self.StageContext(self.Stage.USERS_UPADTE):
-                self.update_users(add_users, remove_users)
+                self.update_users(add_users, remove_users, remove_all_users=remove_all_users)
                 # Fail the stage if any step was failed.
                 if self._stage_severity_from_diagnostics() == Severity.CRITICAL:
                     self.fail_stage(f'Failed to update users')
 
 
-class ManagerUpdateGroupset(PolymorphicManager):
+class ManagerUpdateGroupset(GroupsetJobManager):
     def get_queryset(self):
         return super().get_queryset().filter(
-            type=GroupsetJob.JobType.UPDATE   
+            type=GroupsetJob.JobType.UPDATE
         )
 
 
@@ -272,10 +460,10 @@ class UpdateGroupsetJob(GroupsetJob):
         self.type = GroupsetJob.JobType.UPDATE
 
 
-class ManagerDeleteGroupsetJob(PolymorphicManager):
+class ManagerDeleteGroupsetJob(GroupsetJobManager):
     def get_queryset(self):
         return super().get_queryset().filter(
-            type=GroupsetJob.JobType.DELETE   
+            type=GroupsetJob.JobType.DELETE
         )
 
 
@@ -290,8 +478,10 @@ class DeleteGroupsetJob(GroupsetJob):
         super().__init__(*args, **kwargs)
         self.type = GroupsetJob.JobType.DELETE
 
-    @property
+    @cached_property
     def data(self):
+        # Same for every delete job, built once per job (not shared, it
+        # may be changed in place).
         return {
             'remove_group_ids': ['*'],
             'remove_user_ids': ['*']
@@ -306,6 +496,7 @@ class DeleteGroupsetJob(GroupsetJob):
         # additional unit to delete groupset
         self.add_progress_total_units(1)
         super().act()
+        self.check_cancel_requested()
         with self.StageContext(self.Stage.DELETE_GROUPSET):
             self.delete_groupset()
             if self._stage_severity_from_diagnostics() == Severity.CRITICAL:
@@ -72,3 +72,24 @@ class TestDbRelationships(TestCase):
             self.user.effective_group_names
         )
 
+    def test_effective_group_names_prefetched(self):
+        for _ in range(3):
+            user = factories.UserFactory.create(groups=self.direct_groups)
+            self.groupset.users.add(user)
+        # users + groups + groupsets + groupsets groups, regardless of users
+        with self.assertNumQueries(4):
+            for user in models.User.objects.with_effective_groups():
+                self.assertEquals(
+                    user.effective_group_names,
+                    {g.name for g in self.direct_groups + self.groupset_groups}
+                )
+
+    def test_effective_group_names_cached(self):
+        with self.assertNumQueries(1):
+            names = self.user.effective_group_names
+        with self.assertNumQueries(0):
+            self.assertIs(self.user.effective_group_names, names)
+        self.user.effective_groups
+        with self.assertNumQueries(0):
+            self.user.effective_groups
+            self.user.groupsets_groups_names
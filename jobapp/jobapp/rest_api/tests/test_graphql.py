@@ -0,0 +1,93 @@
+import json
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from jobapp.rest_api.tests import factories
+from jobapp.rest_api import models
+from jobapp.jobapp.graphql_.schema import schema
+
+
+class TestGraphqlQueries(TestCase):
+
+    def setUp(self):
+        for _ in range(3):
+            factories.GroupsetFactory.create(
+                users=factories.UserFactory.create_batch(3),
+                groups=factories.GroupFactory.create_batch(3),
+            )
+
+    def test_groupsets_relations_are_prefetched(self):
+        query = '''
+            {
+                groupsets(first: 10) {
+                    edges {
+                        node {
+                            name
+                            users { edges { node { username } } }
+                            groups { edges { node { name } } }
+                        }
+                    }
+                }
+            }
+        '''
+        # count + groupsets + users prefetch + groups prefetch, regardless of rows.
+        with self.assertNumQueries(4):
+            result = schema.execute(query)
+        self.assertIsNone(result.errors)
+        edges = result.data['groupsets']['edges']
+        self.assertEquals(len(edges), 3)
+        for edge in edges:
+            self.assertEquals(len(edge['node']['users']['edges']), 3)
+            self.assertEquals(len(edge['node']['groups']['edges']), 3)
+
+    def test_jobs_are_not_downcast(self):
+        factories.UpdateGroupsetJobFactoty.create_batch(2)
+        factories.DeleteGroupsetJobFactoty.create_batch(2)
+        query = '{ jobs(first: 10) { edges { node { type status percentProgress } } } }'
+        # count + jobs, no query per job class
+        with self.assertNumQueries(2):
+            result = schema.execute(query)
+        self.assertIsNone(result.errors)
+        self.assertEquals(len(result.data['jobs']['edges']), 4)
+
+    def test_nested_jobs_are_prefetched(self):
+        for groupset in models.Groupset.objects.all():
+            factories.UpdateGroupsetJobFactoty.create(groupset=groupset, _data={'add_user_ids': [1]})
+            factories.DeleteGroupsetJobFactoty.create(groupset=groupset)
+        query = '''
+            {
+                groupsets(first: 10) {
+                    edges { node { groupsetJobs { edges { node { type status } } } } }
+                }
+            }
+        '''
+        # count + groupsets + jobs prefetch, regardless of rows and job classes.
+        with CaptureQueriesContext(connection) as ctx:
+            result = schema.execute(query)
+        self.assertIsNone(result.errors)
+        self.assertEquals(len(ctx.captured_queries), 3)
+        self.assertNotIn('"_data"', ctx.captured_queries[-1]['sql'])
+        for edge in result.data['groupsets']['edges']:
+            self.assertEquals(len(edge['node']['groupsetJobs']['edges']), 2)
+
+    def test_top_level_lists_require_pagination(self):
+        result = schema.execute('{ groupsets { edges { node { name } } } }')
+        self.assertIsNotNone(result.errors)
+
+    def test_diagnostic_details_as_json_string(self):
+        details = schema.get_type('JobDiagnosticType').fields['details']
+        self.assertEquals(details.type.name, 'JSONString')
+
+    def test_nested_diagnostics_details(self):
+        job = factories.UpdateGroupsetJobFactoty.create()
+        job.add_diagnostic(message='ok', details={'i': 1})
+        job.flush_diagnostics()
+        query = '{ jobs(first: 10) { edges { node { diagnostics { edges { node { details } } } } } } }'
+        # count + jobs + diagnostics prefetch
+        with self.assertNumQueries(3):
+            result = schema.execute(query)
+        self.assertIsNone(result.errors)
+        [edge] = result.data['jobs']['edges']
+        [diagnostic] = edge['node']['diagnostics']['edges']
+        self.assertEquals(json.loads(diagnostic['node']['details']), {'i': 1})
@@ -1,4 +1,11 @@
+from unittest import mock
+
+import orjson
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from jobapp.jobapp.exceptions import JobCanceledError
+from jobapp.jobapp.models import DiagnosticQuerySet, JobStatus, Severity, UiStatus
 from jobapp.rest_api.tests import factories
 from jobapp.rest_api import models
 
@@ -20,20 +27,26 @@ class TestGroupsetJob(TestCase):
         models.Group.objects.all().delete()
         models.User.objects.all().delete()
 
-    def test_update_groupset_users_job(self):
-        data = {
+    def create_job(self, **data):
+        # Saved update job of the test groupset
+        job = models.UpdateGroupsetJob(groupset=self.groupset, _data=data)
+        job.save()
+        return job
+
+    def users_data(self):
+        return {
             'add_user_ids': [user.id for user in self.to_add_users],
             'remove_user_ids': [user.id for user in self.to_remove_users],
+        }
+
+    def groups_data(self):
+        return {
             'add_group_ids': [g.id for g in self.to_add_groups],
-            'remove_group_ids': [g.id for g in self.to_remove_groups]
+            'remove_group_ids': [g.id for g in self.to_remove_groups],
         }
-        job = models.UpdateGroupsetJob(
-            groupset=self.groupset,
-            _data=data
-        )
-        job.save()
 
-        # if not any 
+    def test_update_groupset_users_job(self):
+        job = self.create_job(**self.users_data(), **self.groups_data())
         job.run()
 
         print()
@@ -43,4 +56,340 @@ class TestGroupsetJob(TestCase):
                 f'[{dc.created_at}] | severity={dc.severity} | stage={dc.stage} | step={dc.step} | message={dc.message} | details={dc.details}'
             )
         print(job.to_dict())
-        self.assertEquals(self.groupset.last_job, job)
\ No newline at end of file
+        self.assertEquals(self.groupset.last_job, job)
+
+    def test_update_groupset_users_membership(self):
+        job = self.create_job(**self.users_data())
+        job.run()
+        self.assertEquals(
+            set(self.groupset.users.values_list('id', flat=True)),
+            {user.id for user in self.to_add_users}
+        )
+        self.assertEquals(job.diagnostics.filter(step=models.GroupsetJob.Step.ADD_USER).count(), 5)
+
+    def test_check_cancel_requested_reads_status_only(self):
+        job = self.create_job()
+        models.Job.objects.filter(pk=job.pk).update(_status=JobStatus.CANCEL_REQUESTED)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertTrue(job.is_cancel_requested)
+        self.assertEquals(len(ctx.captured_queries), 1)
+        self.assertNotIn('_data', ctx.captured_queries[0]['sql'])
+        with self.assertRaises(JobCanceledError):
+            job.check_cancel_requested()
+        self.assertEquals(job.status, JobStatus.CANCELED)
+
+    def test_to_dict_without_queries(self):
+        job = self.create_job(add_user_ids=[])
+        with self.assertNumQueries(0):
+            job_dict = job.to_dict()
+            message = job.to_message()
+        self.assertEquals(orjson.loads(message)['_data'], job_dict['_data'])
+        self.assertEquals(job_dict['_status'], JobStatus.PENDING)
+        self.assertEquals(job_dict['groupset_id'], self.groupset.id)
+        self.assertEquals(job_dict['_data'], {'add_user_ids': []})
+        # Direct changes are not missed
+        job.description = 'changed'
+        job.data['add_user_ids'].append(1)
+        message = orjson.loads(job.to_message())
+        self.assertEquals(message['description'], 'changed')
+        self.assertEquals(message['_data'], {'add_user_ids': [1]})
+
+    def test_groupset_loaded_with_job(self):
+        job = self.create_job()
+        # Selected where a job is run only, not by the (base) managers
+        with self.assertNumQueries(3):
+            job = models.UpdateGroupsetJob.objects.for_execution().get(pk=job.pk)
+            self.assertEquals(job.groupset, self.groupset)
+
+    def test_deferred_fields_loaded_through_managers(self):
+        job = self.create_job(add_user_ids=[1])
+        job = models.UpdateGroupsetJob.objects.get(pk=job.pk)
+        job.refresh_status()
+        job.refresh(fields=['_progress_done_units'])
+        self.assertEquals(job.status, JobStatus.PENDING)
+        self.assertEquals(self.groupset.last_job.data, {'add_user_ids': [1]})
+
+    def test_groupset_row_not_saved(self):
+        job = self.create_job(**self.groups_data())
+        with CaptureQueriesContext(connection) as ctx:
+            job.run()
+        self.assertFalse([
+            q for q in ctx.captured_queries
+            if q['sql'].startswith('UPDATE "rest_api_groupset"')
+        ])
+        self.assertEquals(
+            set(self.groupset.groups.values_list('id', flat=True)),
+            {g.id for g in self.to_add_groups}
+        )
+
+    def test_users_membership_changed_in_bulk(self):
+        job = self.create_job()
+        with CaptureQueriesContext(connection) as ctx:
+            job.update_users(self.to_add_users, self.to_remove_users)
+        through_table = models.Groupset.users.through._meta.db_table
+        statements = [
+            q['sql'].split(' ', 1)[0] for q in ctx.captured_queries
+            if f'"{through_table}"' in q['sql'] and not q['sql'].startswith('SELECT')
+        ]
+        self.assertEquals(sorted(statements), ['DELETE', 'INSERT'])
+        # Only update_users()' own, nested in the test transaction
+        self.assertEquals(
+            len([q for q in ctx.captured_queries if q['sql'].startswith('SAVEPOINT')]), 1
+        )
+
+    def test_diagnostics_inserted_in_bulk(self):
+        job = self.create_job(**self.users_data())
+        with CaptureQueriesContext(connection) as ctx:
+            job.run()
+        inserts = [
+            q for q in ctx.captured_queries
+            if q['sql'].startswith('INSERT INTO "rest_api_jobdiagnostic"')
+        ]
+        # Stage start, its 10 steps and stage success at stage end.
+        self.assertEquals(len(inserts), 1)
+        self.assertEquals(job.diagnostics.count(), 12)
+
+    def test_final_progress_persisted(self):
+        job = self.create_job(**self.users_data())
+        job.PROGRESS_NOTIFY_INTERVAL = 60
+        job.PROGRESS_NOTIFY_UNITS = 1000
+        job.run()
+        job = models.UpdateGroupsetJob.objects.get(pk=job.pk)
+        self.assertEquals(job.progress_done_units, 10)
+        self.assertEquals(job.percent_progress, 100)
+
+    def test_is_final(self):
+        job = self.create_job()
+        self.assertFalse(job.is_final)
+        job.run()
+        self.assertTrue(job.is_final)
+
+    def test_has_expired_follows_ttl(self):
+        job = models.UpdateGroupsetJob(groupset=self.groupset, _data={})
+        self.assertFalse(job.has_expired)
+        job.save()
+        job.running()
+        self.assertFalse(job.has_expired)
+        self.assertFalse(job.is_stale)
+        with self.assertNumQueries(0):
+            job.ttl = -1
+            self.assertTrue(job.has_expired)
+            self.assertTrue(job.is_stale)
+
+    def test_to_dict_fresh(self):
+        job = self.create_job()
+        models.Job.objects.filter(pk=job.pk).update(_status=JobStatus.CANCEL_REQUESTED)
+        self.assertEquals(job.to_dict()['_status'], JobStatus.PENDING)
+        self.assertEquals(job.to_dict_fresh()['_status'], JobStatus.CANCEL_REQUESTED)
+
+    def test_status_from_diagnostics_without_queries(self):
+        job = models.UpdateGroupsetJob(groupset=self.groupset, _data={})
+        job.add_diagnostic(message='ok')
+        with self.assertNumQueries(0):
+            self.assertEquals(job._stage_severity_from_diagnostics(), Severity.INFO)
+            self.assertEquals(job._job_status_from_diagnostics(), JobStatus.SUCCESS)
+            job.add_diagnostic(severity=Severity.CRITICAL)
+            job.add_diagnostic(severity=Severity.WARNING)
+            self.assertEquals(job._stage_severity_from_diagnostics(), Severity.CRITICAL)
+            self.assertEquals(job._job_status_from_diagnostics(), JobStatus.FAILED)
+
+    def test_act_runs_no_count_queries(self):
+        job = self.create_job(**self.users_data(), **self.groups_data())
+        with CaptureQueriesContext(connection) as ctx:
+            job.run()
+        self.assertFalse([q for q in ctx.captured_queries if 'COUNT(' in q['sql']])
+        # 10 users and the groups update as one unit
+        self.assertEquals(job.progress_total_units, 11)
+        self.assertEquals(job.progress_done_units, 11)
+
+    def test_without_data_defers_data(self):
+        job = self.create_job(add_user_ids=[1])
+        job = models.UpdateGroupsetJob.objects.without_data().get(pk=job.pk)
+        self.assertIn('_data', job.get_deferred_fields())
+        with self.assertNumQueries(0):
+            self.assertEquals(job.status, JobStatus.PENDING)
+        self.assertEquals(job.data, {'add_user_ids': [1]})
+
+    def test_update_ui_status_only(self):
+        job = models.UpdateGroupsetJob(groupset=self.groupset, _data={})
+        job.running()
+        job.pop_dirty_fields()
+        job.update_ui_status(UiStatus.SUCCESS_WITH_WARNING)
+        self.assertEquals(job.status, JobStatus.RUNNING)
+        self.assertEquals(job.ui_status, UiStatus.SUCCESS_WITH_WARNING)
+        self.assertEquals(job.pop_dirty_fields(), {'_status', '_ui_status', 'updated_at'})
+
+    def test_diagnostics_bulk_copy(self):
+        job = self.create_job()
+        diagnostics = [
+            models.JobDiagnostic(job=job, message=f'm{i}', step='', details={'i': i, 's': 'a,"b"'})
+            for i in range(3)
+        ]
+        diagnostics.append(models.JobDiagnostic(job=job, severity=Severity.CRITICAL))
+        with mock.patch.object(DiagnosticQuerySet, 'COPY_THRESHOLD', 1):
+            models.JobDiagnostic.objects.bulk_copy(diagnostics)
+        rows = list(job.diagnostics.order_by('message').values('message', 'step', 'stage', 'details', 'severity'))
+        self.assertEquals(rows[0], {
+            'message': 'm0', 'step': '', 'stage': None,
+            'details': {'i': 0, 's': 'a,"b"'}, 'severity': Severity.INFO
+        })
+        self.assertEquals(rows[-1], {
+            'message': None, 'step': None, 'stage': None,
+            'details': None, 'severity': Severity.CRITICAL
+        })
+
+    def test_stage_severity_scoped_to_current_stage(self):
+        job = models.UpdateGroupsetJob(groupset=self.groupset, _data={})
+        with self.assertNumQueries(0):
+            job.current_stage = models.GroupsetJob.Stage.GROUPS_UPDATE
+            job.add_diagnostic(stage=job.current_stage, severity=Severity.CRITICAL)
+            self.assertEquals(job._stage_severity_from_diagnostics(), Severity.CRITICAL)
+            job.current_stage = models.GroupsetJob.Stage.USERS_UPADTE
+            self.assertEquals(job._stage_severity_from_diagnostics(), Severity.INFO)
+            job.add_diagnostic(stage=job.current_stage, severity=Severity.WARNING)
+            self.assertEquals(job._stage_severity_from_diagnostics(), Severity.WARNING)
+        self.assertEquals(job._job_status_from_diagnostics(), JobStatus.FAILED)
+
+    def test_add_all_users(self):
+        job = self.create_job(add_user_ids=['*'])
+        job.run()
+        self.assertEquals(
+            set(self.groupset.users.values_list('id', flat=True)),
+            set(models.User.objects.values_list('id', flat=True))
+        )
+        self.assertEquals(job.status, JobStatus.SUCCESS)
+
+    def test_last_job_without_data(self):
+        job = self.create_job(add_user_ids=[1])
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEquals(self.groupset.last_job, job)
+        for query in ctx.captured_queries:
+            self.assertNotIn('"_data"', query['sql'])
+
+    def test_status_from_annotated_severity(self):
+        jobs = []
+        for severity in (Severity.WARNING, Severity.CRITICAL):
+            job = self.create_job()
+            job.add_diagnostic(severity=Severity.INFO)
+            job.add_diagnostic(severity=severity)
+            job.flush_diagnostics()
+            jobs.append(job)
+        with self.assertNumQueries(1):
+            loaded = {
+                job.pk: job for job in
+                models.UpdateGroupsetJob.objects.with_max_severity().filter(pk__in=[j.pk for j in jobs])
+            }
+            self.assertEquals(loaded[jobs[0].pk]._job_status_from_diagnostics(), JobStatus.SUCCESS)
+            self.assertEquals(loaded[jobs[1].pk]._job_status_from_diagnostics(), JobStatus.FAILED)
+
+    def test_max_diagnostic_severity_saved_with_job(self):
+        job = self.create_job()
+        job.add_diagnostic(severity=Severity.CRITICAL)
+        job.running()
+        job = models.UpdateGroupsetJob.objects.get(pk=job.pk)
+        with self.assertNumQueries(0):
+            self.assertEquals(job.max_diagnostic_severity, Severity.CRITICAL)
+            self.assertEquals(job._job_status_from_diagnostics(), JobStatus.FAILED)
+
+    def test_for_execution_reads_prefetched_members(self):
+        job = self.create_job(
+            remove_user_ids=[user.id for user in self.to_remove_users[:2]],
+            remove_group_ids=['*'],
+        )
+        job = models.UpdateGroupsetJob.objects.for_execution().get(pk=job.pk)
+        with self.assertNumQueries(0):
+            self.assertEquals(
+                set(job._prefetched_members('users', job.data['remove_user_ids'])),
+                set(self.to_remove_users[:2])
+            )
+            self.assertEquals(
+                job._prefetched_members('users', [str(self.to_remove_users[0].id)]),
+                [self.to_remove_users[0]]
+            )
+            self.assertEquals(
+                set(job._prefetched_members('groups', ['*'], all_members=True)),
+                set(self.to_remove_groups)
+            )
+        job.run()
+        self.assertEquals(
+            set(self.groupset.users.values_list('id', flat=True)),
+            {user.id for user in self.to_remove_users[2:]}
+        )
+        self.assertFalse(self.groupset.groups.exists())
+
+    def test_batch_steps_for_many_users(self):
+        job = self.create_job(**self.users_data())
+        job.BULK_STEPS_MIN_USERS = 10
+        job.run()
+        steps = list(job.diagnostics.exclude(step=None).values_list('step', 'details'))
+        self.assertEquals(sorted(step for step, _ in steps), ['ADD_USER', 'REMOVE_USER'])
+        for step, details in steps:
+            self.assertEquals(details['units'], 5)
+            self.assertEquals(len(details['data']['user_ids']), 5)
+        self.assertEquals(job.progress_done_units, 10)
+        self.assertEquals(job.status, JobStatus.SUCCESS)
+
+    def test_claim_pending(self):
+        first, second = factories.UpdateGroupsetJobFactoty.create_batch(2, groupset=self.groupset)
+        models.UpdateGroupsetJob(groupset=self.groupset, _status=JobStatus.RUNNING).save()
+        notify = models.UpdateGroupsetJob.notify
+        with mock.patch.object(models.UpdateGroupsetJob, 'notify', autospec=True, side_effect=notify) as notified, \
+                CaptureQueriesContext(connection) as ctx:
+            self.assertEquals(models.UpdateGroupsetJob.objects.claim_pending(), [first])
+        notified.assert_called_once_with(first)
+        # Rows of both the parent (job) and child tables are locked
+        [lock] = [q['sql'] for q in ctx.captured_queries if 'FOR UPDATE' in q['sql']]
+        self.assertIn('"rest_api_job"', lock.split('FOR UPDATE', 1)[1])
+        self.assertIn('"rest_api_groupsetjob"', lock.split('FOR UPDATE', 1)[1])
+        self.assertEquals(models.UpdateGroupsetJob.objects.claim_pending(limit=5), [second])
+        self.assertEquals(models.UpdateGroupsetJob.objects.claim_pending(), [])
+        second.refresh_from_db()
+        self.assertEquals(second.status, JobStatus.REQUEST_ACK)
+        self.assertEquals(second.ui_status, UiStatus.REQUEST_ACK)
+
+    def test_remove_all_users_clears(self):
+        job = self.create_job(remove_user_ids=['*'])
+        with CaptureQueriesContext(connection) as ctx:
+            job.run()
+        through_table = models.Groupset.users.through._meta.db_table
+        deletes = [
+            q['sql'] for q in ctx.captured_queries
+            if q['sql'].startswith(f'DELETE FROM "{through_table}"')
+        ]
+        self.assertEquals(len(deletes), 1)
+        self.assertNotIn('"user_id" IN', deletes[0])
+        self.assertFalse(self.groupset.users.exists())
+        self.assertEquals(job.diagnostics.filter(step=models.GroupsetJob.Step.REMOVE_USER).count(), 5)
+
+    def test_delete_job_data_not_shared(self):
+        job, other = models.DeleteGroupsetJob(), models.DeleteGroupsetJob()
+        self.assertIs(job.data, job.data)
+        job.data['remove_user_ids'].append(1)
+        self.assertEquals(other.data, {'remove_group_ids': ['*'], 'remove_user_ids': ['*']})
+
+    def test_status_transitions_named_and_use_update_status(self):
+        self.assertEquals(models.GroupsetJob.running.__name__, 'running')
+        self.assertEquals(models.GroupsetJob.acknowledge.__qualname__, 'AbstractJob.acknowledge')
+        job = models.UpdateGroupsetJob(groupset=self.groupset, _data={})
+        with mock.patch.object(job, 'update_status', wraps=job.update_status) as update_status:
+            job.success()
+        update_status.assert_called_once_with(JobStatus.SUCCESS)
+        self.assertEquals(job.ui_status, UiStatus.SUCCESS)
+
+    def test_idp_sync_failure_isolated_to_users(self):
+        failing_user = self.to_add_users[0]
+
+        def sync_with_idp(user):
+            if user.id == failing_user.id:
+                raise ConnectionError('idp down')
+
+        job = self.create_job(add_user_ids=[user.id for user in self.to_add_users])
+        with mock.patch.object(models.User, 'bulk_sync_with_idp', side_effect=ConnectionError('idp down')), \
+                mock.patch.object(models.User, 'sync_with_idp', autospec=True, side_effect=sync_with_idp):
+            job.run()
+        steps = job.diagnostics.filter(step=models.GroupsetJob.Step.ADD_USER)
+        self.assertEquals(steps.count(), 5)
+        self.assertEquals(
+            [d.details['data']['user_id'] for d in steps.filter(severity=Severity.CRITICAL)],
+            [failing_user.id]
+        )
@@ -0,0 +1,149 @@
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from jobapp.jobapp.models import BatchedDbUpdateNotifier, JobStatus
+from jobapp.rest_api.tests import factories
+from jobapp.rest_api import models
+
+
+class TestBatchedDbUpdateNotifier(TestCase):
+
+    def setUp(self):
+        self.groupset = factories.GroupsetFactory.create()
+        self.job = models.UpdateGroupsetJob(
+            groupset=self.groupset,
+            notifiers=(BatchedDbUpdateNotifier(flush_interval=60),)
+        )
+        self.job.save()
+
+    def _db_status(self):
+        return models.Job.objects.filter(pk=self.job.pk).values_list('_status', flat=True).get()
+
+    def test_updates_are_held_until_flush(self):
+        with self.assertNumQueries(0):
+            self.job.acknowledge()
+            self.job.running()
+        self.assertEquals(self._db_status(), JobStatus.PENDING)
+        self.job.flush_notifications()
+        self.assertEquals(self._db_status(), JobStatus.RUNNING)
+
+    def test_run_flushes(self):
+        self.job._data = {}
+        self.job.run()
+        self.assertEquals(self._db_status(), JobStatus.SUCCESS)
+
+
+class TestDbUpdateNotifier(TestCase):
+
+    def test_saves_only_changed_columns(self):
+        job = models.UpdateGroupsetJob(
+            groupset=factories.GroupsetFactory.create(),
+            _data={'add_user_ids': list(range(100))}
+        )
+        job.save()
+        with CaptureQueriesContext(connection) as ctx:
+            job.running()
+        updates = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEquals(len(updates), 1)
+        self.assertIn('_status', updates[0])
+        self.assertNotIn('_data', updates[0])
+
+    def test_run_saves_running_and_final_status_only(self):
+        job = models.UpdateGroupsetJob(
+            groupset=factories.GroupsetFactory.create(),
+            _data={}
+        )
+        job.save()
+        with CaptureQueriesContext(connection) as ctx:
+            job.run()
+        updates = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('UPDATE')]
+        # RUNNING and SUCCESS, acknowledge is folded into RUNNING.
+        self.assertEquals(len(updates), 2)
+        self.assertEquals(job.status, JobStatus.SUCCESS)
+
+
+class TestProgressNotify(TestCase):
+
+    def test_progress_ticks_are_coalesced(self):
+        job = models.UpdateGroupsetJob(groupset=factories.GroupsetFactory.create())
+        job.PROGRESS_NOTIFY_INTERVAL = 60
+        job.add_progress_total_units(100)
+        job.save()
+        job.add_progress_done_units(1)
+        with self.assertNumQueries(0):
+            for _ in range(job.PROGRESS_NOTIFY_UNITS - 1):
+                job.add_progress_done_units(1)
+        # Progress increment along with the dirty columns
+        with CaptureQueriesContext(connection) as ctx:
+            job.add_progress_done_units(1)
+        self.assertEquals(len(ctx.captured_queries), 1)
+        self.assertIn('"updated_at"', ctx.captured_queries[0]['sql'])
+        self.assertNotIn('_data', ctx.captured_queries[0]['sql'])
+        job.refresh_from_db(fields=['_progress_done_units'])
+        self.assertEquals(job.progress_done_units, job.PROGRESS_NOTIFY_UNITS + 1)
+
+    def test_throttled_without_total_and_past_it(self):
+        job = models.UpdateGroupsetJob(groupset=factories.GroupsetFactory.create())
+        job.PROGRESS_NOTIFY_INTERVAL = 60
+        job.PROGRESS_NOTIFY_UNITS = 1000
+        job.save()
+        job.add_progress_done_units(1)
+        with self.assertNumQueries(0):
+            for _ in range(5):
+                job.add_progress_done_units(1)
+        job.add_progress_total_units(10)
+        with self.assertNumQueries(0):
+            for _ in range(3):
+                job.add_progress_done_units(1)
+        # Reaching the total notifies once, ticks past it do not.
+        with self.assertNumQueries(1):
+            job.add_progress_done_units(1)
+        with self.assertNumQueries(0):
+            for _ in range(5):
+                job.add_progress_done_units(1)
+
+
+class TestBulkUpdateStatus(TestCase):
+
+    def test_single_update_for_many_jobs(self):
+        jobs = factories.UpdateGroupsetJobFactoty.create_batch(5)
+        with CaptureQueriesContext(connection) as ctx:
+            models.GroupsetJob.bulk_update_status(jobs, JobStatus.CANCELED)
+        updates = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEquals(len(updates), 1)
+        self.assertEquals(
+            set(models.Job.objects.filter(pk__in=[j.pk for j in jobs]).values_list('_status', flat=True)),
+            {JobStatus.CANCELED}
+        )
+
+    def test_concurrent_progress_is_not_clobbered(self):
+        job = models.UpdateGroupsetJob(groupset=factories.GroupsetFactory.create())
+        job.add_progress_total_units(10)
+        job.save()
+        other = models.UpdateGroupsetJob.objects.get(pk=job.pk)
+        job.add_progress_done_units(3, notify=False)
+        other.add_progress_done_units(4, notify=False)
+        job.notify()
+        other.notify()
+        # Nothing tracked, whole row save leaves progress to its increments
+        other.notify()
+        self.assertEquals(
+            models.Job.objects.filter(pk=job.pk).values_list('_progress_done_units', flat=True).get(),
+            7
+        )
+
+    def test_batched_progress_is_not_clobbered(self):
+        job = models.UpdateGroupsetJob(groupset=factories.GroupsetFactory.create())
+        job.save()
+        models.Job.objects.filter(pk=job.pk).update(_progress_done_units=5)
+        notifier = BatchedDbUpdateNotifier(flush_interval=60)
+        job._notifiers = (notifier,)
+        job.add_progress_done_units(2, notify=False)
+        with self.assertNumQueries(0):
+            job.notify()
+        notifier.flush()
+        self.assertEquals(job.progress_done_units, 2)
+        self.assertEquals(
+            models.Job.objects.filter(pk=job.pk).values_list('_progress_done_units', flat=True).get(),
+            7
+        )
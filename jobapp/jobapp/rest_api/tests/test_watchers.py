@@ -0,0 +1,86 @@
+from unittest import mock
+
+from django.test import TestCase
+from jobapp.jobapp.models import JobStatus
+from jobapp.jobapp.watchers import CancelWatcher, cancel_watcher
+from jobapp.rest_api.tests import factories
+from jobapp.rest_api import models
+
+
+class TestCancelWatcher(TestCase):
+
+    def setUp(self):
+        self.jobs = factories.UpdateGroupsetJobFactoty.create_batch(3)
+        # Not polled inline by the checks below
+        self.watcher = CancelWatcher(interval=60)
+        for job in self.jobs:
+            self.watcher.register(job)
+
+    def test_poll_single_query(self):
+        canceled_job = self.jobs[0]
+        models.Job.objects.filter(pk=canceled_job.pk).update(
+            _status=JobStatus.CANCEL_REQUESTED
+        )
+        with self.assertNumQueries(1):
+            canceled = self.watcher.poll()
+        self.assertEquals(canceled, {canceled_job})
+        with self.assertNumQueries(0):
+            self.assertTrue(canceled_job.is_cancel_requested)
+            self.assertFalse(self.jobs[1].is_cancel_requested)
+
+    def test_unregister(self):
+        job = self.jobs[0]
+        self.watcher.unregister(job)
+        with self.assertNumQueries(1):
+            self.assertFalse(job.is_cancel_requested)
+
+    def test_handle_payload(self):
+        job = self.jobs[1]
+        self.assertIs(self.watcher.handle_payload(job.cancel_request_payload), job)
+        with self.assertNumQueries(0):
+            self.assertTrue(job.is_cancel_requested)
+            self.assertFalse(self.jobs[0].is_cancel_requested)
+
+    def test_register_cancel_requested_job(self):
+        job = factories.UpdateGroupsetJobFactoty.create()
+        models.Job.objects.filter(pk=job.pk).update(_status=JobStatus.CANCEL_REQUESTED)
+        self.watcher.register(job)
+        with self.assertNumQueries(0):
+            self.assertTrue(job.is_cancel_requested)
+
+    def test_listen_failure_falls_back_to_polling(self):
+        with mock.patch('jobapp.jobapp.watchers.connection') as db_connection, \
+                mock.patch.object(self.watcher, '_listen', side_effect=OSError('lost')), \
+                mock.patch.object(self.watcher, '_poll') as poll:
+            db_connection.vendor = 'postgresql'
+            with self.assertLogs('jobapp.jobapp.watchers', 'ERROR'):
+                self.watcher._run()
+        poll.assert_called_once_with()
+
+    def test_polled_inline_without_thread(self):
+        self.watcher.interval = 0
+        models.Job.objects.filter(pk=self.jobs[0].pk).update(
+            _status=JobStatus.CANCEL_REQUESTED
+        )
+        # One query for all registered jobs
+        with self.assertNumQueries(1):
+            self.assertFalse(self.jobs[1].is_cancel_requested)
+        self.watcher.interval = 60
+        with self.assertNumQueries(0):
+            self.assertTrue(self.jobs[0].is_cancel_requested)
+            self.assertFalse(self.jobs[2].is_cancel_requested)
+
+    def test_run_watches_job(self):
+        job = factories.UpdateGroupsetJobFactoty.create(_data={})
+        with mock.patch.object(cancel_watcher, 'register', wraps=cancel_watcher.register) as register:
+            job.run()
+        register.assert_called_once_with(job)
+        self.assertIsNone(job._cancel_event)
+        self.assertNotIn(CancelWatcher._key(job), cancel_watcher._jobs)
+        self.assertEquals(job.status, JobStatus.SUCCESS)
+
+    def test_run_cancel_requested_job(self):
+        job = factories.UpdateGroupsetJobFactoty.create(_data={})
+        models.Job.objects.filter(pk=job.pk).update(_status=JobStatus.CANCEL_REQUESTED)
+        job.run()
+        self.assertEquals(job.status, JobStatus.CANCELED)
@@ -121,7 +121,10 @@ USE_L10N = True
 
 USE_TZ = True
 
-GRAPHENE = {"SCHEMA": "jobapp.jobapp.graphql_.schema.schema"}
+GRAPHENE = {
+    "SCHEMA": "jobapp.jobapp.graphql_.schema.schema",
+    "RELAY_CONNECTION_MAX_LIMIT": 100,
+}
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/3.0/howto/static-files/
@@ -18,7 +18,6 @@ from django.conf.urls import url
 from graphene_django.views import GraphQLView
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib import admin
-from django.urls import path
 
 
 urlpatterns = [